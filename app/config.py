@@ -53,6 +53,9 @@ class Settings(BaseSettings):
     openai_api_key: str = ""  # 从环境变量加载，默认留空避免泄露
     openai_api_base: Optional[str] = "https://api.longcat.chat/openai/v1"  # OpenAI API Base URL
     openai_model: str = "LongCat-Flash-Chat"  # 使用的模型
+    llm_max_concurrency: int = 16  # 同时进行的 LLM 请求上限
+    llm_batch_window_ms: int = 0  # 合并并发 LLM 请求的等待窗口（毫秒），0 表示不合并
+    llm_skip_threshold: float = 0.95  # 正则恰好找到一个信心值达到此阈值（关键词上下文）的验证码时跳过 LLM（大于 1 表示始终调用 LLM）
     default_code_extraction_method: str = "llm"  # 默认验证码提取方法: "llm" 或 "pattern"
 
     # Admin Authentication (管理员认证)
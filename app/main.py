@@ -108,6 +108,30 @@ async def lifespan(app: FastAPI):
     print("\n👋 Shutting down...")
     cleanup_task.cancel()
 
+    # 關閉 Cloudflare KV 共享 HTTP 客戶端
+    try:
+        from app.services.kv_mail_service import kv_client
+        await kv_client.aclose()
+    except Exception as e:
+        await log_service.log(
+            level=LogLevel.WARNING,
+            log_type=LogType.SYSTEM,
+            message="Error closing KV HTTP client",
+            details={"error": str(e)}
+        )
+
+    # 關閉 LLM 共享 HTTP 客戶端
+    try:
+        from app.services.llm_code_service import llm_code_service
+        await llm_code_service.aclose()
+    except Exception as e:
+        await log_service.log(
+            level=LogLevel.WARNING,
+            log_type=LogType.SYSTEM,
+            message="Error closing LLM HTTP client",
+            details={"error": str(e)}
+        )
+
     # 斷開 Redis 連接
     if settings.enable_redis:
         try:
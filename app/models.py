@@ -28,6 +28,52 @@ class Mail(BaseModel):
     class Config:
         populate_by_name = True
 
+    @classmethod
+    def from_kv_fields(
+        cls,
+        id: str,
+        from_: str,
+        to: str,
+        subject: str,
+        content: str,
+        html_content: Optional[str],
+        received_at: datetime,
+    ) -> "Mail":
+        """
+        由 KV 存储的邮件数据快速构建 Mail
+
+        字段类型均正确时使用 model_construct 跳过逐字段校验；
+        否则（数据异常）回退到常规构造，由 pydantic 校验并抛出错误
+        """
+        if (
+            type(id) is str
+            and type(from_) is str
+            and type(to) is str
+            and type(subject) is str
+            and type(content) is str
+            and (html_content is None or type(html_content) is str)
+        ):
+            return cls.model_construct(
+                id=id,
+                email_token="",
+                from_=from_,
+                to=to,
+                subject=subject,
+                content=content,
+                html_content=html_content,
+                received_at=received_at,
+            )
+        return cls(
+            id=id,
+            email_token="",
+            from_=from_,
+            to=to,
+            subject=subject,
+            content=content,
+            html_content=html_content,
+            received_at=received_at,
+        )
+
 
 # 邮箱模型
 class Email(BaseModel):
@@ -270,6 +270,21 @@ async def get_llm_models(
         }
 
 
+@router.get("/llm/cache-stats")
+async def get_llm_cache_stats(current_user: str = Depends(get_current_user)):
+    """
+    獲取 LLM 提取結果緩存統計（命中/未命中次數與條目數）與進行中的請求數
+    需要登入
+    """
+    from app.services.llm_code_service import llm_code_service
+
+    return {
+        "success": True,
+        "stats": llm_code_service.get_cache_stats(),
+        "inflight": llm_code_service.get_inflight(),
+    }
+
+
 @router.get("/verify")
 async def verify_session_endpoint(current_user: str = Depends(get_current_user)):
     """驗證 JWT 是否有效"""
@@ -1434,7 +1449,8 @@ async def test_and_check_stream(
             data = {"stage": "token", "message": msg, "progress": 20}
             yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-            token_check = await cloudflare_helper._verify_token(api_token, current_language)
+            auth_headers = cloudflare_helper._auth_headers(api_token)
+            token_check = await cloudflare_helper._verify_token(auth_headers, current_language)
 
             data = {
                 "stage": "token",
@@ -1462,7 +1478,7 @@ async def test_and_check_stream(
             data = {"stage": "account", "message": msg, "progress": 40}
             yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-            account_check = await cloudflare_helper._verify_account(account_id, api_token, current_language)
+            account_check = await cloudflare_helper._verify_account(account_id, auth_headers, current_language)
 
             data = {
                 "stage": "account",
@@ -1490,7 +1506,7 @@ async def test_and_check_stream(
             data = {"stage": "namespace", "message": msg, "progress": 60}
             yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-            namespace_check = await cloudflare_helper._verify_namespace(account_id, namespace_id, api_token, current_language)
+            namespace_check = await cloudflare_helper._verify_namespace(account_id, namespace_id, auth_headers, current_language)
 
             data = {
                 "stage": "namespace",
@@ -3,8 +3,10 @@
 用於減少 Cloudflare Workers KV 的讀取次數
 """
 
+import threading
 import time
-from typing import Dict, Optional, Any, Tuple
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Any, Tuple
 
 
 class SimpleCache:
@@ -96,6 +98,65 @@ class SimpleCache:
         }
 
 
+class LRUCache:
+    """
+    固定容量的 LRU 緩存實現（線程安全）
+
+    超出容量時淘汰最久未使用的條目，適合緩存純函數的計算結果；
+    指定 ttl 時條目過期後視為不存在
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        獲取緩存值
+
+        Args:
+            key: 緩存鍵
+
+        Returns:
+            緩存值或 None（如果不存在或已過期）
+        """
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            value, expire_time = item
+            if self.ttl is not None and time.monotonic() > expire_time:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        設置緩存值
+
+        Args:
+            key: 緩存鍵
+            value: 緩存值
+        """
+        expire_time = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+        with self._lock:
+            self._cache[key] = (value, expire_time)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        """清空所有緩存"""
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
 # 全局緩存實例
 # 郵件索引緩存 (TTL: 30 秒)
 mail_index_cache = SimpleCache()
@@ -10,7 +10,7 @@ Cloudflare 配置辅助服务
 import asyncio
 import json
 import subprocess
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Mapping, Optional, Tuple
 import httpx
 
 from app.services.log_service import log_service, LogLevel, LogType
@@ -19,6 +19,9 @@ from app.services.log_service import log_service, LogLevel, LogType
 class CloudflareHelper:
     """Cloudflare 配置辅助工具"""
 
+    # Wrangler 自动检测的总超时预算（秒）
+    WRANGLER_DETECT_BUDGET = 12
+
     @staticmethod
     def get_wizard_steps(language: str = "zh-CN") -> List[Dict[str, Any]]:
         """
@@ -81,6 +84,21 @@ class CloudflareHelper:
             }
         ]
 
+    @staticmethod
+    def _auth_headers(api_token: str) -> Dict[str, str]:
+        """构建 Cloudflare API 认证请求头（同一轮验证中只构建一次并复用）"""
+        return {"Authorization": f"Bearer {api_token}"}
+
+    @staticmethod
+    def _extract_cf_error(response: httpx.Response) -> str:
+        """从 Cloudflare API 错误响应中提取首条错误信息"""
+        try:
+            errors = response.json().get("errors") or [{}]
+            message = errors[0].get("message")
+        except (ValueError, IndexError, AttributeError):
+            message = None
+        return message or response.text[:100] or "未知错误"
+
     @staticmethod
     async def test_connection(
         account_id: str,
@@ -105,10 +123,11 @@ class CloudflareHelper:
         """
         checks = []
         overall_status = "success"
+        auth_headers = CloudflareHelper._auth_headers(api_token)
 
         try:
             # 检查 1: 验证 API Token
-            token_check = await CloudflareHelper._verify_token(api_token)
+            token_check = await CloudflareHelper._verify_token(auth_headers)
             checks.append(token_check)
 
             if token_check["status"] != "passed":
@@ -121,7 +140,7 @@ class CloudflareHelper:
                 }
 
             # 检查 2: 验证 Account ID（尝试列出 KV Namespaces）
-            account_check = await CloudflareHelper._verify_account(account_id, api_token)
+            account_check = await CloudflareHelper._verify_account(account_id, auth_headers)
             checks.append(account_check)
 
             if account_check["status"] != "passed":
@@ -135,7 +154,7 @@ class CloudflareHelper:
 
             # 检查 3: 验证 Namespace ID（尝试读取 KV keys）
             namespace_check = await CloudflareHelper._verify_namespace(
-                account_id, namespace_id, api_token
+                account_id, namespace_id, auth_headers
             )
             checks.append(namespace_check)
 
@@ -185,16 +204,15 @@ class CloudflareHelper:
             }
 
     @staticmethod
-    async def _verify_token(api_token: str, language: str = "en-US") -> Dict[str, Any]:
+    async def _verify_token(auth_headers: Mapping[str, str], language: str = "en-US") -> Dict[str, Any]:
         """验证 API Token 是否有效"""
         from app.i18n.translations import translation_manager as tm
 
         try:
             url = "https://api.cloudflare.com/client/v4/user/tokens/verify"
-            headers = {"Authorization": f"Bearer {api_token}"}
 
             async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=headers)
+                response = await client.get(url, headers=auth_headers)
 
                 if response.status_code == 200:
                     data = response.json()
@@ -222,22 +240,21 @@ class CloudflareHelper:
             }
 
     @staticmethod
-    async def _get_token_accounts(api_token: str) -> List[str]:
+    async def _get_token_accounts(auth_headers: Mapping[str, str]) -> List[str]:
         """
         获取 Token 有权访问的所有 Account ID
 
         Args:
-            api_token: Cloudflare API Token
+            auth_headers: Cloudflare API 认证请求头
 
         Returns:
             Account ID 列表（如果失败返回空列表）
         """
         try:
             url = "https://api.cloudflare.com/client/v4/accounts"
-            headers = {"Authorization": f"Bearer {api_token}"}
 
             async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=headers, params={"per_page": 50})
+                response = await client.get(url, headers=auth_headers, params={"per_page": 50})
 
                 if response.status_code == 200:
                     data = response.json()
@@ -257,20 +274,20 @@ class CloudflareHelper:
             return []
 
     @staticmethod
-    async def _get_namespace_account(namespace_id: str, api_token: str) -> Optional[str]:
+    async def _get_namespace_account(namespace_id: str, auth_headers: Mapping[str, str]) -> Optional[str]:
         """
         获取 Namespace 实际所属的 Account ID（通过搜索所有可访问的 Accounts）
 
         Args:
             namespace_id: KV Namespace ID
-            api_token: Cloudflare API Token
+            auth_headers: Cloudflare API 认证请求头
 
         Returns:
             Account ID（如果找到），否则返回 None
         """
         try:
             # 先获取所有可访问的 Accounts
-            token_accounts = await CloudflareHelper._get_token_accounts(api_token)
+            token_accounts = await CloudflareHelper._get_token_accounts(auth_headers)
 
             if not token_accounts:
                 return None
@@ -279,10 +296,9 @@ class CloudflareHelper:
             for account_id in token_accounts:
                 try:
                     url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces"
-                    headers = {"Authorization": f"Bearer {api_token}"}
 
                     async with httpx.AsyncClient(timeout=10.0) as client:
-                        response = await client.get(url, headers=headers, params={"per_page": 100})
+                        response = await client.get(url, headers=auth_headers, params={"per_page": 100})
 
                         if response.status_code == 200:
                             data = response.json()
@@ -309,16 +325,15 @@ class CloudflareHelper:
             return None
 
     @staticmethod
-    async def _verify_account(account_id: str, api_token: str, language: str = "en-US") -> Dict[str, Any]:
+    async def _verify_account(account_id: str, auth_headers: Mapping[str, str], language: str = "en-US") -> Dict[str, Any]:
         """验证 Account ID 是否正确（增强版：检测 Token 可访问的 Accounts）"""
         from app.i18n.translations import translation_manager as tm
 
         try:
             url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces"
-            headers = {"Authorization": f"Bearer {api_token}"}
 
             async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=headers, params={"per_page": 1})
+                response = await client.get(url, headers=auth_headers, params={"per_page": 1})
 
                 if response.status_code == 200:
                     data = response.json()
@@ -342,7 +357,7 @@ class CloudflareHelper:
                     }
                 elif response.status_code == 404:
                     # ⭐ 增强：检查 Token 实际能访问哪些 Accounts
-                    token_accounts = await CloudflareHelper._get_token_accounts(api_token)
+                    token_accounts = await CloudflareHelper._get_token_accounts(auth_headers)
 
                     if token_accounts:
                         accounts_preview = ", ".join([acc[:8] + "..." for acc in token_accounts[:3]])
@@ -386,7 +401,7 @@ class CloudflareHelper:
     async def _verify_namespace(
         account_id: str,
         namespace_id: str,
-        api_token: str,
+        auth_headers: Mapping[str, str],
         language: str = "en-US"
     ) -> Dict[str, Any]:
         """验证 Namespace ID 是否可访问"""
@@ -394,10 +409,9 @@ class CloudflareHelper:
 
         try:
             url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/keys"
-            headers = {"Authorization": f"Bearer {api_token}"}
 
             async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=headers, params={"limit": 10})
+                response = await client.get(url, headers=auth_headers, params={"limit": 10})
 
                 # 记录详细的响应信息用于调试
                 await log_service.log(
@@ -424,23 +438,13 @@ class CloudflareHelper:
                         }
                 elif response.status_code == 400:
                     # HTTP 400: Bad Request - 通常是请求参数错误
-                    try:
-                        error_data = response.json()
-                        errors = error_data.get("errors", [])
-                        error_msg = errors[0].get("message", "未知错误") if errors else "请求格式错误"
-                        return {
-                            "name": "KV Namespace 访问",
-                            "status": "failed",
-                            "message": f"请求参数错误: {error_msg}",
-                            "icon": "❌"
-                        }
-                    except:
-                        return {
-                            "name": "KV Namespace 访问",
-                            "status": "failed",
-                            "message": "请求参数错误 (HTTP 400)，请检查 Account ID 和 Namespace ID 格式",
-                            "icon": "❌"
-                        }
+                    error_msg = CloudflareHelper._extract_cf_error(response)
+                    return {
+                        "name": "KV Namespace 访问",
+                        "status": "failed",
+                        "message": f"请求参数错误: {error_msg}",
+                        "icon": "❌"
+                    }
                 elif response.status_code == 403:
                     return {
                         "name": "KV Namespace 访问",
@@ -450,7 +454,7 @@ class CloudflareHelper:
                     }
                 elif response.status_code == 404:
                     # ⭐ 增强：检查 Namespace 实际属于哪个 Account
-                    actual_account = await CloudflareHelper._get_namespace_account(namespace_id, api_token)
+                    actual_account = await CloudflareHelper._get_namespace_account(namespace_id, auth_headers)
 
                     if actual_account and actual_account != account_id:
                         return {
@@ -474,12 +478,7 @@ class CloudflareHelper:
                         }
 
                 # 其他错误返回详细信息
-                try:
-                    error_data = response.json()
-                    errors = error_data.get("errors", [])
-                    error_msg = errors[0].get("message", "") if errors else response.text[:100]
-                except:
-                    error_msg = response.text[:100] if response.text else "未知错误"
+                error_msg = CloudflareHelper._extract_cf_error(response)
 
                 return {
                     "name": "KV Namespace 访问",
@@ -532,9 +531,11 @@ class CloudflareHelper:
             "suggestions": []
         }
 
+        auth_headers = CloudflareHelper._auth_headers(api_token)
+
         try:
             # 获取 Token 可访问的 Accounts
-            token_accounts = await CloudflareHelper._get_token_accounts(api_token)
+            token_accounts = await CloudflareHelper._get_token_accounts(auth_headers)
             result["token_accounts"] = token_accounts
 
             # 检查 Token 是否能访问指定的 Account
@@ -553,7 +554,7 @@ class CloudflareHelper:
                 )
 
             # 获取 Namespace 实际所属的 Account
-            namespace_account = await CloudflareHelper._get_namespace_account(namespace_id, api_token)
+            namespace_account = await CloudflareHelper._get_namespace_account(namespace_id, auth_headers)
             result["namespace_account"] = namespace_account
 
             if namespace_account:
@@ -1023,11 +1024,29 @@ class CloudflareHelper:
             检测结果字典
         """
         try:
-            # 检查 Wrangler 是否安装
-            version_result = await CloudflareHelper._run_command(
-                ["wrangler", "--version"],
-                timeout=5
-            )
+            # 三条 Wrangler 命令共享同一超时预算，避免慢速 Wrangler 长时间阻塞向导 UI
+            try:
+                async with asyncio.timeout(CloudflareHelper.WRANGLER_DETECT_BUDGET):
+                    # 检查 Wrangler 是否安装
+                    version_result = await CloudflareHelper._run_command(
+                        ["wrangler", "--version"],
+                        timeout=5
+                    )
+
+                    # 获取 Account ID 与 KV Namespaces 列表（互不依赖，并行执行）
+                    if version_result[0]:
+                        whoami_result, kv_list_result = await asyncio.gather(
+                            CloudflareHelper._run_command(["wrangler", "whoami"]),
+                            CloudflareHelper._run_command(["wrangler", "kv", "namespace", "list"])
+                        )
+            except TimeoutError:
+                return {
+                    "success": False,
+                    "detected": False,
+                    "error": f"Wrangler 命令执行超时 ({CloudflareHelper.WRANGLER_DETECT_BUDGET}s)",
+                    "suggestion": "请检查网络连接或 Wrangler 登录状态后重试",
+                    "fallback_hint": "✨ 即使自动检测失败，您仍可点击「📖 配置向导」按钮，获取详细的配置步骤指引"
+                }
 
             if not version_result[0]:
                 return {
@@ -1040,12 +1059,6 @@ class CloudflareHelper:
 
             wrangler_version = version_result[1].strip()
 
-            # 获取 Account ID
-            whoami_result = await CloudflareHelper._run_command(
-                ["wrangler", "whoami"],
-                timeout=10
-            )
-
             if not whoami_result[0]:
                 return {
                     "success": False,
@@ -1095,12 +1108,6 @@ class CloudflareHelper:
                     "fallback_hint": "✨ 即使自动检测失败，您仍可点击「📖 配置向导」按钮，获取详细的配置步骤指引"
                 }
 
-            # 获取 KV Namespaces 列表
-            kv_list_result = await CloudflareHelper._run_command(
-                ["wrangler", "kv", "namespace", "list"],
-                timeout=10
-            )
-
             namespace_id = None
             namespace_title = None
 
@@ -1215,12 +1222,17 @@ class CloudflareHelper:
 
     # ==================== New: KV Namespace Utilities ====================
     @staticmethod
-    async def list_kv_namespaces(account_id: str, api_token: str, search: Optional[str] = None) -> Dict[str, Any]:
-        """列出 KV Namespaces（支持 search）"""
+    async def list_kv_namespaces(
+        account_id: str,
+        api_token: str,
+        search: Optional[str] = None,
+        per_page: int = 100
+    ) -> Dict[str, Any]:
+        """列出 KV Namespaces（支持 search 与 per_page）"""
         try:
             url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces"
             headers = {"Authorization": f"Bearer {api_token}"}
-            params = {"per_page": 100}
+            params = {"per_page": per_page}
             if search:
                 params["search"] = search
 
@@ -1235,26 +1247,39 @@ class CloudflareHelper:
 
     @staticmethod
     async def ensure_kv_namespace(account_id: str, api_token: str, title: str) -> Dict[str, Any]:
-        """确保 namespace 存在；不存在则创建"""
-        try:
-            # 查找是否已存在
-            listed = await CloudflareHelper.list_kv_namespaces(account_id, api_token, search=title)
-            if listed.get("success"):
-                for ns in listed.get("namespaces", []):
-                    if ns.get("title") == title:
-                        return {"success": True, "created": False, "id": ns.get("id"), "title": title}
+        """
+        确保 namespace 存在；不存在则创建
 
-            # 创建新 namespace
+        先乐观地直接 POST 创建（首次部署只需一次往返），创建未成功时一律回退到
+        list 查找已有 ID：除"namespace 已存在" (错误码 10014) 外，只读 Token 的
+        401/403 等权限错误也可能对应一个已存在、只需取回 ID 的 namespace。
+        两个请求同时创建同名 namespace 时，落败的一方会收到冲突并取回胜出方的 ID。
+        """
+        try:
+            # 直接尝试创建新 namespace
             url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces"
             headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
             payload = {"title": title}
             async with httpx.AsyncClient(timeout=10.0) as client:
                 resp = await client.post(url, headers=headers, json=payload)
+            try:
                 data = resp.json()
-                if resp.status_code == 200 and data.get("success"):
-                    rid = data.get("result", {}).get("id")
-                    return {"success": True, "created": True, "id": rid, "title": title}
-                return {"success": False, "status": resp.status_code, "message": data.get("errors") or data}
+            except ValueError:
+                data = {}
+            if resp.status_code == 200 and data.get("success"):
+                rid = data.get("result", {}).get("id")
+                return {"success": True, "created": True, "id": rid, "title": title}
+
+            # 创建失败（已存在、权限不足等）：查找现有 namespace 的 ID
+            errors = data.get("errors") or []
+            # search 为模糊匹配，同前缀的 namespace 可能很多，使用默认页大小以免漏掉精确匹配
+            listed = await CloudflareHelper.list_kv_namespaces(account_id, api_token, search=title)
+            if listed.get("success"):
+                for ns in listed.get("namespaces", []):
+                    if ns.get("title") == title:
+                        return {"success": True, "created": False, "id": ns.get("id"), "title": title}
+
+            return {"success": False, "status": resp.status_code, "message": errors or data}
         except Exception as e:
             return {"success": False, "message": str(e)}
 
@@ -1400,14 +1425,25 @@ class CloudflareHelper:
         env["PATH"] = path_separator.join(unique_paths)
         return env
 
+    @staticmethod
+    def _kill_process(process: Optional[asyncio.subprocess.Process]) -> None:
+        """终止仍在运行的子进程"""
+        if process is not None and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+
     @staticmethod
     async def _run_command(
         command: List[str],
-        timeout: int = 10
+        timeout: int = 6
     ) -> Tuple[bool, str]:
         """
         执行 Shell 命令（使用增强的环境变量）
 
+        超时或被外层取消时会终止子进程，避免残留的 Wrangler 进程。
+
         Args:
             command: 命令和参数列表
             timeout: 超时时间（秒）
@@ -1415,6 +1451,7 @@ class CloudflareHelper:
         Returns:
             (是否成功, 输出内容)
         """
+        process = None
         try:
             # 获取增强的环境变量
             env = CloudflareHelper._get_enhanced_env()
@@ -1465,7 +1502,11 @@ class CloudflareHelper:
                 )
                 return (False, error)
 
+        except asyncio.CancelledError:
+            CloudflareHelper._kill_process(process)
+            raise
         except asyncio.TimeoutError:
+            CloudflareHelper._kill_process(process)
             error_msg = f"命令执行超时 ({timeout}s)"
             await log_service.log(
                 level=LogLevel.ERROR,
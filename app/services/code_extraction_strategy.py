@@ -9,10 +9,40 @@
 根據配置和上下文智能選擇最佳提取方法
 """
 
+import asyncio
+import threading
 import time
 from typing import List, Optional, Tuple
 from app.models import Mail, Code
 from app.config import settings
+from app.services.code_service import code_service, html_to_text
+from app.services.llm_code_service import llm_code_service
+from app.services.pattern_code_service import pattern_code_service
+
+
+class _MailText:
+    """
+    單封郵件的提取輸入
+
+    HTML 去標籤文本延遲計算且只計算一次，供 Pattern / LLM / Regex 三種方法共用
+    （Pattern 與 Regex 在不同線程中並行執行，以鎖保證只解析一次）
+    """
+
+    __slots__ = ("content", "html_content", "_html_text", "_lock")
+
+    def __init__(self, mail: Mail):
+        self.content = mail.content or ""
+        self.html_content = mail.html_content
+        self._html_text: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def html_text(self) -> str:
+        if self._html_text is None:
+            with self._lock:
+                if self._html_text is None:
+                    self._html_text = html_to_text(self.html_content) if self.html_content else ""
+        return self._html_text
 
 
 class CodeExtractionStrategy:
@@ -44,22 +74,23 @@ class CodeExtractionStrategy:
         self._stats["total_attempts"] += 1
 
         debug = bool(getattr(settings, "debug_email_fetch", False))
+        text = _MailText(mail)
 
         # 如果指定了特定方法，直接使用
         if preferred_method == "pattern":
-            codes, method = await self._extract_with_pattern(mail)
+            codes, method = await self._extract_with_pattern(text)
             if codes:
                 duration_ms = (time.time() - start_time) * 1000
                 return codes, method, duration_ms
 
         elif preferred_method == "llm":
-            codes, method = await self._extract_with_llm(mail)
+            codes, method = await self._extract_with_llm(text)
             if codes:
                 duration_ms = (time.time() - start_time) * 1000
                 return codes, method, duration_ms
 
         elif preferred_method == "regex":
-            codes, method = await self._extract_with_regex(mail)
+            codes, method = await self._extract_with_regex(text)
             duration_ms = (time.time() - start_time) * 1000
             return codes, method, duration_ms
 
@@ -67,27 +98,43 @@ class CodeExtractionStrategy:
         if debug:
             print(f"[Code Extraction] Starting smart extraction for mail from {mail.from_}")
 
+        # Pattern 與 Regex 均為純 CPU 計算，在線程中並行執行；
+        # Regex 結果僅在 Pattern 與 LLM 都不滿足時使用。提前返回時 cancel() 只丟棄
+        # regex_task 的結果，已開始的線程仍會跑完（單次正則掃描，開銷有限）
+        pattern_task = asyncio.create_task(self._extract_with_pattern(text))
+        regex_task = asyncio.create_task(self._extract_with_regex(text))
+
         # Step 1: 嘗試 Pattern-based（最快，0 成本）
-        codes, method = await self._extract_with_pattern(mail)
+        try:
+            codes, method = await pattern_task
+        except BaseException:
+            regex_task.cancel()
+            raise
         if codes and codes[0].confidence >= 0.85:
             if debug:
                 print(f"[Code Extraction] Pattern-based succeeded: {codes[0].code} (confidence: {codes[0].confidence})")
             self._stats["pattern_success"] += 1
+            regex_task.cancel()
             duration_ms = (time.time() - start_time) * 1000
             return codes, method, duration_ms
 
         # Step 2: 嘗試 LLM-based（智能但有成本）
         if settings.use_llm_extraction:
-            codes, method = await self._extract_with_llm(mail)
+            try:
+                codes, method = await self._extract_with_llm(text)
+            except BaseException:
+                regex_task.cancel()
+                raise
             if codes and codes[0].confidence >= 0.80:
                 if debug:
                     print(f"[Code Extraction] LLM-based succeeded: {codes[0].code} (confidence: {codes[0].confidence})")
                 self._stats["llm_success"] += 1
+                regex_task.cancel()
                 duration_ms = (time.time() - start_time) * 1000
                 return codes, method, duration_ms
 
-        # Step 3: 回退到 Regex-based（兜底）
-        codes, method = await self._extract_with_regex(mail)
+        # Step 3: 回退到 Regex-based（兜底，通常已在 Step 1 期間完成）
+        codes, method = await regex_task
         if codes:
             if debug:
                 print(f"[Code Extraction] Regex-based succeeded: {codes[0].code} (confidence: {codes[0].confidence})")
@@ -96,17 +143,19 @@ class CodeExtractionStrategy:
         duration_ms = (time.time() - start_time) * 1000
         return codes, method, duration_ms
 
-    async def _extract_with_pattern(self, mail: Mail) -> Tuple[List[Code], str]:
-        """使用 Pattern-based 提取"""
-        try:
-            from app.services.pattern_code_service import pattern_code_service
+    async def _extract_with_pattern(self, text: _MailText) -> Tuple[List[Code], str]:
+        """使用 Pattern-based 提取（在線程中執行，不阻塞事件循環）"""
+        return await asyncio.to_thread(self._sync_extract_pattern, text)
 
-            # 先從純文本提取
-            codes = pattern_code_service.extract_codes(mail.content or "")
+    def _sync_extract_pattern(self, text: _MailText) -> Tuple[List[Code], str]:
+        """Pattern-based 提取（同步，可在線程中執行）"""
+        try:
+            # 先從純文本提取（純 HTML 郵件跳過空文本的掃描）
+            codes = pattern_code_service.extract_codes(text.content) if text.content else []
 
             # 如果沒找到且有 HTML，從 HTML 提取
-            if not codes and mail.html_content:
-                codes = pattern_code_service.extract_from_html(mail.html_content)
+            if not codes and text.html_content:
+                codes = pattern_code_service.extract_codes(text.html_text)
 
             return codes, "pattern"
         except Exception as e:
@@ -115,17 +164,16 @@ class CodeExtractionStrategy:
                 print(f"[Code Extraction] Pattern extraction error: {e}")
             return [], "pattern"
 
-    async def _extract_with_llm(self, mail: Mail) -> Tuple[List[Code], str]:
+    async def _extract_with_llm(self, text: _MailText) -> Tuple[List[Code], str]:
         """使用 LLM-based 提取"""
         try:
-            from app.services.llm_code_service import llm_code_service
-
-            # 先從純文本提取
-            codes = await llm_code_service.extract_codes(mail.content or "")
+            # 先從純文本提取（純 HTML 郵件跳過空文本的掃描）
+            codes = await llm_code_service.extract_codes(text.content) if text.content else []
 
             # 如果沒找到且有 HTML，從 HTML 提取
-            if not codes and mail.html_content:
-                codes = await llm_code_service.extract_from_html(mail.html_content)
+            if not codes and text.html_content:
+                html_text = await asyncio.to_thread(lambda: text.html_text)
+                codes = await llm_code_service.extract_codes(html_text)
 
             return codes, "llm"
         except Exception as e:
@@ -134,17 +182,19 @@ class CodeExtractionStrategy:
                 print(f"[Code Extraction] LLM extraction error: {e}")
             return [], "llm"
 
-    async def _extract_with_regex(self, mail: Mail) -> Tuple[List[Code], str]:
-        """使用 Regex-based 提取"""
-        try:
-            from app.services.code_service import code_service
+    async def _extract_with_regex(self, text: _MailText) -> Tuple[List[Code], str]:
+        """使用 Regex-based 提取（在線程中執行，不阻塞事件循環）"""
+        return await asyncio.to_thread(self._sync_extract_regex, text)
 
-            # 先從純文本提取
-            codes = code_service.extract_codes(mail.content or "")
+    def _sync_extract_regex(self, text: _MailText) -> Tuple[List[Code], str]:
+        """Regex-based 提取（同步，可在線程中執行）"""
+        try:
+            # 先從純文本提取（純 HTML 郵件跳過空文本的掃描）
+            codes = code_service.extract_codes(text.content) if text.content else []
 
             # 如果沒找到且有 HTML，從 HTML 提取
-            if not codes and mail.html_content:
-                codes = code_service.extract_from_html(mail.html_content)
+            if not codes and text.html_content:
+                codes = code_service.extract_codes(text.html_text)
 
             return codes, "regex"
         except Exception as e:
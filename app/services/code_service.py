@@ -1,109 +1,183 @@
 import re
+from hashlib import blake2b
+from html import unescape
+from operator import attrgetter
 from typing import List
 from app.models import Code
+from app.services.cache_service import LRUCache
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # selectolax 未安装时回退到正则去标签
+    LexborHTMLParser = None
+
+
+# 预编译的验证码正则（模块加载时编译一次）
+# 1. 纯数字验证码 (4-8位)：单次扫描，按匹配长度决定 pattern 与置信度
+_NUMERIC_RE = re.compile(r"\b(\d{4}|\d{6}|\d{8})\b")
+_NUMERIC_SPECS = {
+    6: (r"\b\d{6}\b", 0.9),
+    4: (r"\b\d{4}\b", 0.8),
+    8: (r"\b\d{8}\b", 0.85),
+}
+
+_ASCII_DIGITS = "0123456789"
+
+# 2. 字母數字混合 (6-10位)
+_ALPHANUM_RE = re.compile(r"\b[A-Z0-9]{6,10}\b")
+
+# 3. 常见验证码关键词附近
+_CONTEXT_RES = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"(?:code|Code|驗證碼|验证码|OTP|otp)[\s:：]*([A-Z0-9]{4,10})",
+        r"(?:your|Your)\s+(?:verification|code)[\s:：]*([A-Z0-9]{4,10})",
+        r"(?:token|Token)[\s:：]*([A-Za-z0-9_-]{10,40})",
+    )
+]
+
+# 4. URL参数中的验证码
+_URL_RE = re.compile(r"[?&](?:code|token|verify)=([A-Za-z0-9_-]+)", re.IGNORECASE)
+
+# 排序键（C 实现，比 lambda 更快）
+_BY_CONFIDENCE = attrgetter("confidence")
+
+# HTML 标签（selectolax 不可用时的回退方案）
+_TAG_RE = re.compile(r"<[^>]*>")
+
+
+def may_contain_digits(text: str) -> bool:
+    """
+    快速预检文本是否可能含有数字，用于跳过无数字文本的数字正则扫描
+
+    逐字符的 `in` 查找在 C 层完成，远快于正则逐位置尝试匹配。
+    非 ASCII 文本可能含全角等 Unicode 数字（\\d 可匹配），保守地返回 True。
+    """
+    if not text.isascii():
+        return True
+    return any(digit in text for digit in _ASCII_DIGITS)
+
+
+def html_to_text(html: str) -> str:
+    """
+    将 HTML 转为用于验证码提取的纯文本
+
+    优先使用 selectolax（C 解析器，自动解码实体，并丢弃脚本/样式中的伪验证码），
+    未安装时回退到正则去标签 + html.unescape。
+    不含 "<" 的输入没有标签可去，跳过解析，仅在含 "&" 时解码实体。
+    """
+    if "<" not in html:
+        return unescape(html) if "&" in html else html
+
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html)
+        for node in tree.css("script, style, head"):
+            node.decompose()
+        root = tree.body or tree.root
+        return root.text(separator=" ") if root else ""
+
+    return unescape(_TAG_RE.sub(" ", html))
 
 
 class CodeService:
     """验证码提取服务"""
 
+    def __init__(self):
+        # 相同正文的提取结果缓存（以正文摘要为键，避免保留大段正文）
+        self._cache = LRUCache(maxsize=512)
+
     def extract_codes(self, text: str) -> List[Code]:
+        """从文本中提取验证码（相同正文直接返回缓存结果的副本）"""
+        key = blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._extract_codes(text)
+            self._cache.set(key, cached)
+        return [code.model_copy() for code in cached]
+
+    def _extract_codes(self, text: str) -> List[Code]:
         """从文本中提取验证码"""
         codes: List[Code] = []
-
-        # 1. 纯数字验证码 (4-8位)
-        numeric_patterns = [
-            (r"\b\d{6}\b", "numeric", 6, 0.9),
-            (r"\b\d{4}\b", "numeric", 4, 0.8),
-            (r"\b\d{8}\b", "numeric", 8, 0.85),
-        ]
-
-        for pattern, type_, length, confidence in numeric_patterns:
-            matches = re.findall(pattern, text)
-            for code in matches:
-                if not self._is_duplicate(codes, code):
-                    codes.append(
-                        Code(
-                            code=code,
-                            type=type_,
-                            length=length,
-                            pattern=pattern,
-                            confidence=confidence,
-                        )
-                    )
+        seen = set()
+
+        # 1. 纯数字验证码 (4-8位)，无数字时跳过
+        numeric_matches = _NUMERIC_RE.findall(text) if may_contain_digits(text) else []
+        for code in numeric_matches:
+            if code in seen:
+                continue
+            seen.add(code)
+            length = len(code)
+            pattern, confidence = _NUMERIC_SPECS[length]
+            codes.append(
+                Code(
+                    code=code,
+                    type="numeric",
+                    length=length,
+                    pattern=pattern,
+                    confidence=confidence,
+                )
+            )
 
         # 2. 字母數字混合 (6-10位)
-        alphanumeric_pattern = r"\b[A-Z0-9]{6,10}\b"
-        matches = re.findall(alphanumeric_pattern, text)
+        matches = _ALPHANUM_RE.findall(text)
         for code in matches:
-            if not self._is_duplicate(codes, code):
-                codes.append(
-                    Code(
-                        code=code,
-                        type="alphanumeric",
-                        length=len(code),
-                        pattern=alphanumeric_pattern,
-                        confidence=0.75,
-                    )
+            if code in seen:
+                continue
+            seen.add(code)
+            codes.append(
+                Code(
+                    code=code,
+                    type="alphanumeric",
+                    length=len(code),
+                    pattern=_ALPHANUM_RE.pattern,
+                    confidence=0.75,
                 )
+            )
 
         # 3. 常见验证码关键词附近
-        context_patterns = [
-            r"(?:code|Code|驗證碼|验证码|OTP|otp)[\s:：]*([A-Z0-9]{4,10})",
-            r"(?:your|Your)\s+(?:verification|code)[\s:：]*([A-Z0-9]{4,10})",
-            r"(?:token|Token)[\s:：]*([A-Za-z0-9_-]{10,40})",
-        ]
-
-        for pattern in context_patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
+        for regex in _CONTEXT_RES:
+            matches = regex.findall(text)
             for code in matches:
-                if not self._is_duplicate(codes, code):
-                    type_ = "token" if len(code) > 15 else "alphanumeric"
-                    codes.append(
-                        Code(
-                            code=code,
-                            type=type_,
-                            length=len(code),
-                            pattern=pattern,
-                            confidence=0.95,  # 上下文关键词提高置信度
-                        )
-                    )
-
-        # 4. URL参数中的验证码
-        url_pattern = r"[?&](?:code|token|verify)=([A-Za-z0-9_-]+)"
-        matches = re.findall(url_pattern, text, re.IGNORECASE)
-        for code in matches:
-            if not self._is_duplicate(codes, code) and len(code) >= 6:
+                if code in seen:
+                    continue
+                seen.add(code)
                 type_ = "token" if len(code) > 15 else "alphanumeric"
                 codes.append(
                     Code(
                         code=code,
                         type=type_,
                         length=len(code),
-                        pattern=url_pattern,
-                        confidence=0.85,
+                        pattern=regex.pattern,
+                        confidence=0.95,  # 上下文关键词提高置信度
                     )
                 )
 
-        # 按置信度排序
-        return sorted(codes, key=lambda x: x.confidence, reverse=True)
+        # 4. URL参数中的验证码
+        matches = _URL_RE.findall(text)
+        for code in matches:
+            if code in seen or len(code) < 6:
+                continue
+            seen.add(code)
+            type_ = "token" if len(code) > 15 else "alphanumeric"
+            codes.append(
+                Code(
+                    code=code,
+                    type=type_,
+                    length=len(code),
+                    pattern=_URL_RE.pattern,
+                    confidence=0.85,
+                )
+            )
 
-    def _is_duplicate(self, codes: List[Code], code: str) -> bool:
-        """检查是否重复"""
-        return any(c.code == code for c in codes)
+        # 按置信度原地排序（稳定排序，同置信度保持发现顺序）
+        codes.sort(key=_BY_CONFIDENCE, reverse=True)
+        return codes
 
     def extract_from_html(self, html: str) -> List[Code]:
         """从HTML中提取验证码"""
-        # 移除HTML标签
-        text = re.sub(r"<[^>]*>", " ", html)
-        # 解码HTML实体
-        text = self._decode_html_entities(text)
-        return self.extract_codes(text)
-
-    def _decode_html_entities(self, text: str) -> str:
-        """解码HTML实体"""
-        import html
-
-        return html.unescape(text)
+        if not html:
+            return []
+        return self.extract_codes(html_to_text(html))
 
 
 # 单例
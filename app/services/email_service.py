@@ -1,14 +1,37 @@
 import secrets
 import re
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from app.config import get_active_domains, get_default_domain, parse_domain_list, settings
 from app.models import Email
 
 
+# 郵箱格式
+_EMAIL_RE = re.compile(r"^[^\s@]+@[^\s@]+\.[^\s@]+$")
+
+
 class EmailService:
     """郵箱生成服務"""
 
+    def __init__(self):
+        # 活躍域名緩存，以相關設定值作為簽名，設定變更後自動重新計算
+        self._domains_cached: Optional[Tuple[str, ...]] = None
+        self._domains_sig: Optional[tuple] = None
+
+    def _active_domains(self) -> Tuple[str, ...]:
+        """獲取活躍域名（設定未變更時直接返回緩存）"""
+        sig = (
+            settings.use_cloudflare_kv,
+            settings.cf_kv_domains,
+            settings.enable_custom_domains,
+            settings.custom_domains,
+            settings.enable_builtin_domains,
+        )
+        if sig != self._domains_sig or self._domains_cached is None:
+            self._domains_cached = tuple(get_active_domains())
+            self._domains_sig = sig
+        return self._domains_cached
+
     def generate_email(self, prefix: str = None, domain: str = None) -> Email:
         """
         生成隨機郵箱
@@ -63,8 +86,7 @@ class EmailService:
 
         從所有可用域名中真正隨機選擇，確保每個域名都有相等的選擇機率
         """
-        active_domains = get_active_domains()
-        return secrets.choice(active_domains)
+        return secrets.choice(self._active_domains())
 
     def validate_domain(self, domain: str) -> bool:
         """
@@ -76,12 +98,11 @@ class EmailService:
         Returns:
             bool: 域名是否有效
         """
-        active_domains = get_active_domains()
-        return domain in active_domains
+        return domain in self._active_domains()
 
     def get_available_domains(self) -> list[str]:
         """獲取所有可用域名列表"""
-        return get_active_domains()
+        return list(self._active_domains())
 
     def get_domain_info(self) -> dict:
         """
@@ -90,7 +111,7 @@ class EmailService:
         Returns:
             dict: 包含域名來源和統計信息
         """
-        active = get_active_domains()
+        active = self._active_domains()
         custom = parse_domain_list(settings.custom_domains) if settings.custom_domains else []
         default = get_default_domain()
 
@@ -104,8 +125,7 @@ class EmailService:
 
     def validate_email(self, email: str) -> bool:
         """驗證郵箱格式"""
-        pattern = r"^[^\s@]+@[^\s@]+\.[^\s@]+$"
-        return bool(re.match(pattern, email))
+        return _EMAIL_RE.match(email) is not None
 
     def is_expired(self, email: Email) -> bool:
         """檢查郵箱是否過期"""
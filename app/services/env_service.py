@@ -4,7 +4,9 @@
 """
 
 import os
-from typing import Dict, Optional, Any
+import shutil
+import tempfile
+from typing import Dict, Optional, Any, Tuple
 from pathlib import Path
 import re
 
@@ -14,15 +16,24 @@ class EnvService:
 
     def __init__(self, env_path: str = ".env"):
         self.env_path = Path(env_path)
+        # 解析結果緩存，以檔案 (mtime_ns, size) 作為失效判斷
+        self._cache: Optional[Dict[str, str]] = None
+        self._cache_signature: Optional[Tuple[int, int]] = None
 
     def read_env(self) -> Dict[str, str]:
         """
         讀取 .env 檔案內容
-        返回 key-value 字典
+        返回 key-value 字典（檔案未變更時直接返回緩存副本）
         """
-        if not self.env_path.exists():
+        try:
+            st = self.env_path.stat()
+        except FileNotFoundError:
             return {}
 
+        signature = (st.st_mtime_ns, st.st_size)
+        if self._cache is not None and signature == self._cache_signature:
+            return self._cache.copy()
+
         env_dict = {}
         try:
             with open(self.env_path, "r", encoding="utf-8") as f:
@@ -34,13 +45,12 @@ class EnvService:
                         continue
 
                     # 解析 KEY=VALUE 格式
-                    match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)$', line)
-                    if match:
-                        key, value = match.groups()
+                    parsed = self._split_line(line)
+                    if parsed:
+                        key, value = parsed
                         # 移除引號
                         value = value.strip()
-                        if (value.startswith('"') and value.endswith('"')) or \
-                           (value.startswith("'") and value.endswith("'")):
+                        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
                             value = value[1:-1]
                         env_dict[key] = value
 
@@ -48,7 +58,9 @@ class EnvService:
             print(f"讀取 .env 檔案失敗: {e}")
             return {}
 
-        return env_dict
+        self._cache = env_dict
+        self._cache_signature = signature
+        return env_dict.copy()
 
     def write_env(self, config: Dict[str, Any], preserve_comments: bool = True) -> bool:
         """
@@ -75,9 +87,9 @@ class EnvService:
                             existing_lines.append(line)
                         else:
                             # 檢查是否為 KEY=VALUE
-                            match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=', stripped)
-                            if match:
-                                key = match.group(1)
+                            parsed = self._split_line(stripped)
+                            if parsed:
+                                key = parsed[0]
                                 existing_keys.add(key)
                                 # 如果 config 中有這個 key，使用新值
                                 if key in config:
@@ -96,19 +108,42 @@ class EnvService:
                     formatted_value = self._format_value(value)
                     new_lines.append(f"{key}={formatted_value}\n")
 
-            # 寫入檔案
-            with open(self.env_path, "w", encoding="utf-8") as f:
-                f.writelines(existing_lines)
-                if new_lines:
-                    f.write("\n# Auto-generated settings\n")
-                    f.writelines(new_lines)
+            content = "".join(existing_lines)
+            if new_lines:
+                content += "\n# Auto-generated settings\n" + "".join(new_lines)
 
+            # 原子寫入：先寫入同目錄的臨時檔案並 fsync，再以 os.replace 替換，
+            # 避免寫入中途崩潰留下截斷的配置，並發寫入者也不會互相覆蓋半份內容
+            self._atomic_write(content)
+
+            self._cache = None
             return True
 
         except Exception as e:
             print(f"寫入 .env 檔案失敗: {e}")
             return False
 
+    def _atomic_write(self, content: str):
+        """以臨時檔案 + os.replace 原子地替換 .env 檔案（保留原檔案權限）"""
+        directory = self.env_path.parent
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f".{self.env_path.name}.", suffix=".tmp", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            if self.env_path.exists():
+                shutil.copymode(self.env_path, tmp_path)
+            os.replace(tmp_path, self.env_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
     def update_env(self, updates: Dict[str, Any]) -> bool:
         """
         更新特定的環境變數
@@ -129,6 +164,20 @@ class EnvService:
         env_dict = self.read_env()
         return env_dict.get(key, default)
 
+    @staticmethod
+    def _split_line(line: str) -> Optional[Tuple[str, str]]:
+        """
+        將 KEY=VALUE 行拆分為 (key, value)
+        key 需為 ASCII 識別符，否則返回 None
+        """
+        key, sep, value = line.partition("=")
+        if not sep:
+            return None
+        key = key.strip()
+        if not (key.isascii() and key.isidentifier()):
+            return None
+        return key, value
+
     def _format_value(self, value: Any) -> str:
         """
         格式化配置值
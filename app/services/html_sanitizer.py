@@ -6,15 +6,71 @@ HTML 清理服務 - 安全地清理郵件 HTML 內容
 """
 
 import re
+from hashlib import blake2b
 from typing import Optional
 from html import escape, unescape
 
+from app.services.cache_service import LRUCache
+
+try:
+    import nh3
+except ImportError:  # nh3 未安裝時使用內建的標記掃描器
+    nh3 = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # selectolax 未安裝時以正則去除標籤
+    LexborHTMLParser = None
+
+
+# 單次掃描的標記：註釋 / 聲明 / 開始或結束標籤
+# 標籤內容不跨越 "<"，確保未閉合的標籤不會導致反覆掃描到文末
+_TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|\Z)|<[!?][^<>]*>|<(/?)([a-zA-Z][a-zA-Z0-9]*)([^<>]*)>',
+    re.DOTALL
+)
+
+# 屬性：name、是否有值、雙引號值、單引號值、無引號值
+_ATTR_RE = re.compile(
+    r'([^\s"\'<>/=]+)(\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'<>]+)))?'
+)
+
+# 快速預檢：可能含有 on* 屬性（屬性名前為空白、引號或斜線）
+_EVENT_ATTR_HINT_RE = re.compile(r'(?:^|[\s"\'/])on', re.IGNORECASE)
+
+# 快速預檢：可能為前導/預覽區塊
+_PREHEADER_HINT_RE = re.compile(r'preheader|preview-text', re.IGNORECASE)
+
+# script/style 的結束標籤
+_RAW_TEXT_END_RES = {
+    tag: re.compile(rf'</{tag}\b[^<>]*>', re.IGNORECASE)
+    for tag in ("script", "style")
+}
+
+# nh3 輸出中的 a / img 開始標籤：屬性值一律以雙引號包裹，值內的 " 與 > 已被轉義
+_NH3_LINK_IMG_RE = re.compile(r'<(a|img)((?: [^\s"\'<>/=]+(?:="[^"]*")?)*)>')
+
+# nh3 輸出中需要併入安全 token 的屬性：標籤 -> (屬性值正則, 屬性名, 併入的 token)
+_NH3_MERGE_ATTRS = {
+    "a": (re.compile(r' rel="([^"]*)"'), "rel", "noopener noreferrer"),
+    "img": (re.compile(r' class="([^"]*)"'), "class", "mail-content-image"),
+}
+
+# 純文本提取（_strip_all_tags）；不跨越 "<"，避免大量未閉合 "<" 時的二次方回溯
+_STRIP_TAGS_RE = re.compile(r'<[^<>]+>')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# 空白清理（_cleanup_whitespace）
+_MULTI_SPACE_RE = re.compile(r'[ \t]{2,}')
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+_TAG_GAP_RE = re.compile(r'>\s+<')
+
 
 class HtmlSanitizer:
     """HTML 清理器 - 使用白名單方式清理 HTML"""
 
     # 允許的標籤（白名單）
-    ALLOWED_TAGS = {
+    ALLOWED_TAGS = frozenset({
         # 連結
         "a",
         # 圖片
@@ -30,30 +86,69 @@ class HtmlSanitizer:
         "table", "thead", "tbody", "tr", "td", "th",
         # 區塊
         "div", "span",
-    }
+    })
 
-    # 允許的屬性（按標籤分類）
+    # 允許的屬性（按標籤分類，nh3 清理時生效）
     ALLOWED_ATTRIBUTES = {
-        "a": ["href", "title", "rel", "target"],
-        "img": ["src", "alt", "title", "width", "height"],
-        "td": ["colspan", "rowspan"],
-        "th": ["colspan", "rowspan"],
-        "*": ["class", "id"],  # 全局屬性
+        "a": frozenset({"href", "title", "rel", "target"}),
+        "img": frozenset({"src", "alt", "title", "width", "height"}),
+        "table": frozenset({"cellpadding", "cellspacing", "border"}),
+        "td": frozenset({"colspan", "rowspan", "valign", "bgcolor"}),
+        "th": frozenset({"colspan", "rowspan", "valign", "bgcolor"}),
+        # 全局屬性（郵件排版依賴內聯樣式與表格屬性）
+        "*": frozenset({"class", "id", "style", "align", "width", "height", "dir"}),
     }
 
     # 危險標籤（必須移除）
-    DANGEROUS_TAGS = {
+    DANGEROUS_TAGS = frozenset({
         "script", "style", "iframe", "frame", "frameset",
         "object", "embed", "applet", "link", "meta", "base"
+    })
+
+    # 危險標籤中的空元素（無結束標籤，只移除標籤本身）
+    DANGEROUS_VOID_TAGS = frozenset({"frame", "embed", "link", "meta", "base"})
+
+    # 原始文本元素（內容不含標記，直接跳到結束標籤）
+    RAW_TEXT_TAGS = frozenset({"script", "style"})
+
+    # 塊級元素（移除時以換行替換，行內元素以空格替換）
+    BLOCK_ELEMENTS = frozenset({
+        "div", "p", "h1", "h2", "h3", "h4", "h5", "h6",
+        "ul", "ol", "li", "table", "tr", "td", "th",
+        "blockquote", "pre", "hr", "br",
+    })
+
+    # 郵件前導/預覽區塊的 class 關鍵字（僅作用於 div / span）
+    PREHEADER_CLASS_KEYWORDS = ("preheader", "preview-text", "hidden-preheader")
+
+    # nh3 清理參數（類定義時構建一次）
+    # 連結的 rel 與圖片的 class 不交給 nh3 設置（會覆蓋原值），清理後再併入，與標記掃描器一致
+    NH3_CLEAN_CONTENT_TAGS = DANGEROUS_TAGS - DANGEROUS_VOID_TAGS
+    NH3_SET_ATTRIBUTES = {
+        "a": {"target": "_blank"},
+        "img": {"loading": "lazy"},
     }
 
-    # 危險屬性模式（事件處理器）
-    DANGEROUS_ATTR_PATTERN = re.compile(r'^on\w+', re.IGNORECASE)
+    # 超過此長度的 HTML 直接轉為純文本，限制最壞情況的 CPU 開銷
+    MAX_HTML_LENGTH = 5_000_000
+
+    # 超過此長度的清理結果不緩存：LRU 只限制條目數，需避免大郵件佔滿內存
+    MAX_CACHED_LENGTH = 256 * 1024
+
+    def __init__(self):
+        # 清理結果緩存（以內容摘要為鍵）；同一郵件在列表、詳情、預覽中會被重複清理
+        self._cache = LRUCache(maxsize=512)
+        self._preview_cache = LRUCache(maxsize=512)
 
     def sanitize(self, html: Optional[str]) -> Optional[str]:
         """
         清理 HTML 內容
 
+        已安裝 nh3 時由其（Rust 實現的 HTML 解析器）一次完成白名單清理，
+        前導/預覽區塊（nh3 無法按 class 移除）在此之前單獨移除；
+        否則以單次標記掃描完成危險標籤移除、事件屬性過濾、前導區塊移除、
+        白名單過濾以及連結/圖片屬性處理，避免多次正則掃描全文。
+
         Args:
             html: 原始 HTML 內容
 
@@ -63,26 +158,33 @@ class HtmlSanitizer:
         if not html:
             return None
 
-        try:
-            # 步驟 1: 移除危險標籤
-            html = self._remove_dangerous_tags(html)
-
-            # 步驟 2: 移除危險屬性（事件處理器）
-            html = self._remove_dangerous_attributes(html)
-
-            # 步驟 3: 移除典型郵件「前導/預覽」區塊，避免在移除 <style> 後意外顯示造成重複
-            html = self._remove_preheader_sections(html)
-
-            # 步驟 4: 過濾標籤（白名單）
-            html = self._filter_tags(html)
-
-            # 步驟 5: 處理連結（自動添加安全屬性）
-            html = self._secure_links(html)
+        # 不含 "<" 的純文本無法構成任何標籤，只需清理空白
+        if "<" not in html:
+            return self._cleanup_whitespace(html)
+
+        key = _digest(html)
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._sanitize(html)
+            if len(cached) <= self.MAX_CACHED_LENGTH:
+                self._cache.set(key, cached)
+        return cached
+
+    def _sanitize(self, html: str) -> str:
+        """清理 HTML 內容（未緩存）"""
+        if len(html) > self.MAX_HTML_LENGTH:
+            return self._strip_all_tags(html)
 
-            # 步驟 6: 處理圖片（添加樣式類）
-            html = self._process_images(html)
+        try:
+            if nh3 is not None:
+                # 無論是否含前導區塊都必須經過 nh3：前導區塊先移除，安全清理始終由 nh3 完成
+                if _PREHEADER_HINT_RE.search(html):
+                    html = self._remove_preheaders(html)
+                html = self._sanitize_nh3(html)
+            else:
+                html = self._sanitize_tokens(html)
 
-            # 步驟 7: 清理多餘的空白字符（但保留有意義的空格和換行）
+            # 清理多餘的空白字符（但保留有意義的空格和換行）
             html = self._cleanup_whitespace(html)
 
             return html
@@ -92,180 +194,219 @@ class HtmlSanitizer:
             print(f"[HTML Sanitizer] Error sanitizing HTML: {e}")
             return self._strip_all_tags(html)
 
-    def _remove_dangerous_tags(self, html: str) -> str:
-        """移除危險標籤（script, style, iframe 等）"""
-        for tag in self.DANGEROUS_TAGS:
-            # 移除開始和結束標籤及其內容
-            pattern = rf'<{tag}[^>]*>.*?</{tag}>'
-            html = re.sub(pattern, '', html, flags=re.DOTALL | re.IGNORECASE)
-            # 移除自閉合標籤
-            pattern = rf'<{tag}[^>]*/?>'
-            html = re.sub(pattern, '', html, flags=re.IGNORECASE)
-        return html
-
-    def _remove_dangerous_attributes(self, html: str) -> str:
-        """移除危險屬性（on* 事件處理器）"""
-        # 匹配標籤中的 on* 屬性
-        pattern = r'<([a-zA-Z][a-zA-Z0-9]*)\s+([^>]*?)>'
-
-        def clean_attrs(match):
-            tag_name = match.group(1)
-            attrs = match.group(2)
-
-            # 移除 on* 屬性
-            attrs = re.sub(r'\s+on\w+\s*=\s*["\'][^"\']*["\']', '', attrs, flags=re.IGNORECASE)
-            attrs = re.sub(r'\s+on\w+\s*=\s*[^\s>]+', '', attrs, flags=re.IGNORECASE)
-
-            return f'<{tag_name} {attrs}>'.replace('  ', ' ').replace('< ', '<')
-
-        return re.sub(pattern, clean_attrs, html)
-
-    def _filter_tags(self, html: str) -> str:
+    def _remove_preheaders(self, html: str) -> str:
         """
-        過濾標籤（白名單）- 改進版：移除標籤時保留空格
+        移除郵件前導/預覽區塊（在 nh3 清理之前執行，不負責安全過濾）
 
-        注意：這是簡化實現，生產環境建議使用 bleach 庫
+        優先使用 selectolax 按 class/id 移除整個 div/span 區塊；
+        未安裝時借用標記掃描器完成移除，其輸出仍會再經過 nh3 清理
         """
-        # 塊級元素列表（移除時應添加換行）
-        block_elements = {'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-                         'ul', 'ol', 'li', 'table', 'tr', 'td', 'th',
-                         'blockquote', 'pre', 'hr', 'br'}
-
-        # 移除不在白名單中的標籤
-        def replace_tag(match):
-            is_closing = match.group(1) == '/'
-            tag_name = match.group(2).lower()
-            full_tag = match.group(0)
-
-            if tag_name in self.ALLOWED_TAGS:
-                return full_tag
-            else:
-                # 移除標籤時保留適當的空白
-                # 塊級元素用換行替換，行內元素用空格替換
-                if tag_name in block_elements:
-                    return '\n' if is_closing else '\n'
-                else:
-                    return ' '
-
-        # 匹配開始標籤和結束標籤
-        pattern = r'<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*?>'
-        return re.sub(pattern, replace_tag, html)
-
-    def _secure_links(self, html: str) -> str:
+        if LexborHTMLParser is None:
+            return self._sanitize_tokens(html)
+
+        tree = LexborHTMLParser(html)
+        removed = False
+        for node in tree.css("div, span"):
+            attrs = node.attributes
+            if self._is_preheader_values(attrs.get("class"), attrs.get("id")):
+                node.decompose()
+                removed = True
+        return tree.html if removed else html
+
+    def _sanitize_nh3(self, html: str) -> str:
         """
-        處理連結，自動添加安全屬性
+        使用 nh3 清理 HTML
 
-        - target="_blank" (在新標籤頁打開)
-        - rel="noopener noreferrer" (防止 window.opener 攻擊)
+        - 危險標籤連同內容一起丟棄，非白名單標籤只保留文本
+        - 只保留白名單屬性，並過濾 javascript: 等不安全的 URL
+        - 連結設置 target="_blank" 並併入 rel="noopener noreferrer"，
+          圖片設置 loading 並併入 class="mail-content-image"（保留作者原有的 rel/class）
         """
-        pattern = r'<a\s+([^>]*?)>'
-
-        def add_security_attrs(match):
-            attrs = match.group(1)
-
-            # 檢查是否已有 target
-            if 'target=' not in attrs.lower():
-                attrs += ' target="_blank"'
-
-            # 檢查是否已有 rel
-            if 'rel=' not in attrs.lower():
-                attrs += ' rel="noopener noreferrer"'
-            else:
-                # 如果已有 rel，確保包含 noopener noreferrer
-                attrs = re.sub(
-                    r'rel\s*=\s*["\']([^"\']*)["\']',
-                    lambda m: f'rel="{m.group(1)} noopener noreferrer"',
-                    attrs
-                )
-
-            return f'<a {attrs}>'.replace('  ', ' ')
-
-        return re.sub(pattern, add_security_attrs, html, flags=re.IGNORECASE)
-
-    def _process_images(self, html: str) -> str:
+        html = nh3.clean(
+            html,
+            tags=self.ALLOWED_TAGS,
+            clean_content_tags=self.NH3_CLEAN_CONTENT_TAGS,
+            attributes=self.ALLOWED_ATTRIBUTES,
+            link_rel=None,
+            set_tag_attribute_values=self.NH3_SET_ATTRIBUTES,
+        )
+        return _NH3_LINK_IMG_RE.sub(_merge_nh3_attributes, html)
+
+    def _sanitize_tokens(self, html: str) -> str:
         """
-        處理圖片，添加樣式類和 loading="lazy"
+        單次掃描所有標記並輸出清理後的 HTML
+
+        - 危險標籤連同內容一起丟棄（空元素只丟棄標籤；未閉合時丟棄其後全部內容）
+        - 移除 on* 事件屬性，其餘屬性原樣保留
+        - 移除 class 含 preheader 等關鍵字或 id="preheader" 的 div/span 區塊（考慮巢狀）
+        - 非白名單標籤以換行（塊級）或空格（行內）替換，保留其文本
+        - 連結補上 target/rel 安全屬性，圖片補上 loading/class
+        - 註釋、DOCTYPE 等聲明一律丟棄
         """
-        pattern = r'<img\s+([^>]*?)>'
+        parts = []
+        pos = 0
+        skip_tag = None  # 正在跳過的區塊標籤（iframe、前導區塊等）
+        skip_depth = 0
+        length = len(html)
+
+        while pos < length:
+            match = _TOKEN_RE.search(html, pos)
+            end = match.start() if match else length
+
+            # 文本原樣輸出，未構成標籤的 "<" 需轉義
+            if skip_tag is None and end > pos:
+                parts.append(html[pos:end].replace("<", "&lt;"))
+            if match is None:
+                break
+            pos = match.end()
+
+            closing, tag, attrs = match.groups()
+            if tag is None:
+                # 註釋或聲明
+                continue
+
+            tag = tag.lower()
+            is_closing = closing == "/"
+
+            if skip_tag is not None:
+                if tag == skip_tag:
+                    skip_depth += -1 if is_closing else 1
+                    if skip_depth == 0:
+                        skip_tag = None
+                continue
+
+            if tag in self.DANGEROUS_TAGS:
+                if is_closing or tag in self.DANGEROUS_VOID_TAGS:
+                    continue
+                if tag in self.RAW_TEXT_TAGS:
+                    # script/style 內容不解析標記，直接跳到結束標籤
+                    raw_end = _RAW_TEXT_END_RES[tag].search(html, pos)
+                    pos = raw_end.end() if raw_end else length
+                else:
+                    skip_tag, skip_depth = tag, 1
+                continue
 
-        def add_img_attrs(match):
-            attrs = match.group(1)
+            if not is_closing and tag in ("div", "span") and self._is_preheader(attrs):
+                skip_tag, skip_depth = tag, 1
+                continue
 
-            # 添加 loading="lazy" (延遲加載)
-            if 'loading=' not in attrs.lower():
-                attrs += ' loading="lazy"'
+            if tag not in self.ALLOWED_TAGS:
+                # 移除標籤時保留適當的空白：塊級元素用換行替換，行內元素用空格替換
+                parts.append("\n" if tag in self.BLOCK_ELEMENTS else " ")
+                continue
 
-            # 添加 class (用於 CSS 樣式)
-            if 'class=' not in attrs.lower():
-                attrs += ' class="mail-content-image"'
+            if is_closing:
+                parts.append(f"</{tag}>")
             else:
-                # 如果已有 class，追加 mail-content-image
-                attrs = re.sub(
-                    r'class\s*=\s*["\']([^"\']*)["\']',
-                    lambda m: f'class="{m.group(1)} mail-content-image"',
-                    attrs
-                )
-
-            return f'<img {attrs}>'.replace('  ', ' ')
-
-        return re.sub(pattern, add_img_attrs, html, flags=re.IGNORECASE)
+                parts.append(self._render_starttag(tag, attrs))
+
+        return "".join(parts)
+
+    def _is_preheader(self, attrs: str) -> bool:
+        """判斷 div/span 是否為郵件前導/預覽區塊"""
+        if not attrs or not _PREHEADER_HINT_RE.search(attrs):
+            return False
+        for name, _, dq, sq, bare in _ATTR_RE.findall(attrs):
+            name = name.lower()
+            value = dq or sq or bare
+            if name == "class" and self._is_preheader_values(value, None):
+                return True
+            if name == "id" and self._is_preheader_values(None, value):
+                return True
+        return False
+
+    def _is_preheader_values(self, class_value: Optional[str], id_value: Optional[str]) -> bool:
+        """按 class / id 屬性值判斷是否為前導/預覽區塊"""
+        if class_value:
+            class_value = class_value.lower()
+            if any(k in class_value for k in self.PREHEADER_CLASS_KEYWORDS):
+                return True
+        return bool(id_value) and id_value.lower() == "preheader"
+
+    def _render_starttag(self, tag: str, attrs: str) -> str:
+        """重新輸出允許的開始標籤：移除 on* 屬性，並為連結/圖片補上屬性"""
+        if tag != "a" and tag != "img" and not _EVENT_ATTR_HINT_RE.search(attrs):
+            # 無需改寫的標籤（絕大多數）直接保留原屬性
+            return f"<{tag}{attrs}>"
+
+        cleaned = {}
+        for name, has_value, dq, sq, bare in _ATTR_RE.findall(attrs):
+            name = name.lower()
+            # 移除 on* 事件處理器；重複屬性以第一個為準（與瀏覽器一致）
+            if _is_event_handler(name) or name in cleaned:
+                continue
+            cleaned[name] = (dq or sq or bare) if has_value else None
+
+        if tag == "a":
+            # target="_blank" 在新標籤頁打開；rel 防止 window.opener 攻擊
+            cleaned.setdefault("target", "_blank")
+            cleaned["rel"] = _merge_tokens(cleaned.get("rel"), "noopener noreferrer")
+        elif tag == "img":
+            # 延遲加載 + 用於 CSS 樣式的 class
+            cleaned.setdefault("loading", "lazy")
+            cleaned["class"] = _merge_tokens(cleaned.get("class"), "mail-content-image")
+
+        rendered = []
+        for name, value in cleaned.items():
+            if value is None:
+                rendered.append(f" {name}")
+            else:
+                value = value.replace('"', "&quot;")
+                rendered.append(f' {name}="{value}"')
+        return f"<{tag}{''.join(rendered)}>"
 
     def _strip_all_tags(self, html: str) -> str:
         """
         移除所有 HTML 標籤，返回純文本
 
-        用於清理失敗時的回退方案
+        用於清理失敗時的回退方案與文本預覽。優先使用 selectolax（C 解析器，
+        正確處理屬性值中的 ">" 並自動解碼實體，同時丟棄 script/style/iframe 內容），
+        不可用或解析失敗時回退到正則去除標籤。
         """
-        # 移除所有標籤
-        text = re.sub(r'<[^>]+>', '', html)
-
-        # 解碼 HTML 實體
-        text = unescape(text)
+        text = None
+        if LexborHTMLParser is not None:
+            try:
+                tree = LexborHTMLParser(html)
+                for node in tree.css("script, style, iframe"):
+                    node.decompose()
+                root = tree.body or tree.root
+                text = root.text(separator=" ") if root else ""
+            except Exception:
+                text = None
+
+        if text is None:
+            # 移除所有標籤並解碼 HTML 實體
+            text = unescape(_STRIP_TAGS_RE.sub('', html))
 
         # 清理多餘空白
-        text = re.sub(r'\s+', ' ', text)
+        text = _WHITESPACE_RE.sub(' ', text)
         text = text.strip()
 
         return text
 
-    def _remove_preheader_sections(self, html: str) -> str:
-        """
-        移除常見郵件的前導/預覽文字區塊，避免在移除 <style> 後顯示造成「內容重複」。
-
-        規則（保守處理）：
-        - 刪除 class 名稱包含 preheader / preview-text / hidden-preheader 的 div/span
-        - 刪除 id 為 preheader 的 div/span
-        僅作用於 div / span，避免過度刪除主要內容區塊。
-        """
-        try:
-            pattern_class = r'<(div|span)([^>]*?class\s*=\s*"[^"]*(preheader|preview-text|hidden-preheader)[^"]*"[^>]*)>.*?</\1>'
-            pattern_id = r'<(div|span)([^>]*?id\s*=\s*"preheader"[^>]*)>.*?</\1>'
-            html = re.sub(pattern_class, '', html, flags=re.IGNORECASE | re.DOTALL)
-            html = re.sub(pattern_id, '', html, flags=re.IGNORECASE | re.DOTALL)
-        except Exception:
-            # 最壞情況保持原樣
-            pass
-        return html
-
     def _cleanup_whitespace(self, html: str) -> str:
         """
         清理多餘的空白字符，但保留有意義的空格和換行
 
         處理策略：
-        1. 合併多個連續空格為一個（在文本節點內）
-        2. 清理多餘的換行（最多保留兩個連續換行）
-        3. 移除標籤前後多餘的空白
+        1. 移除標籤之間的空白
+        2. 合併多個連續空格為一個（在文本節點內）
+        3. 清理多餘的換行（最多保留兩個連續換行）
+
+        標籤之間的空白是完整的空白段，先移除它們不會影響其餘兩步的匹配；
+        其餘兩步以 C 層的子串查找預檢，已整潔的 HTML 不再做無替換的整文掃描。
         """
         try:
-            # 合併多個空格為一個（但不跨越標籤邊界）
-            html = re.sub(r'(?<=>)\s+(?=<)', ' ', html)  # 標籤之間的空白
-            html = re.sub(r'[ \t]{2,}', ' ', html)  # 文本中的多個空格
+            # 移除標籤之間的換行和空格
+            html = _TAG_GAP_RE.sub('><', html)
 
-            # 清理多餘的換行（最多保留兩個）
-            html = re.sub(r'\n{3,}', '\n\n', html)
+            # 文本中的多個空格合併為一個
+            if '  ' in html or '\t' in html:
+                html = _MULTI_SPACE_RE.sub(' ', html)
 
-            # 移除標籤前後的空白（但保留文本前後的單個空格）
-            html = re.sub(r'>\s+<', '><', html)  # 移除標籤之間的換行和空格
+            # 清理多餘的換行（最多保留兩個）
+            if '\n\n\n' in html:
+                html = _MULTI_NEWLINE_RE.sub('\n\n', html)
 
             return html
         except Exception:
@@ -285,6 +426,11 @@ class HtmlSanitizer:
         if not html:
             return ""
 
+        key = (_digest(html), max_length)
+        cached = self._preview_cache.get(key)
+        if cached is not None:
+            return cached
+
         # 移除所有標籤
         text = self._strip_all_tags(html)
 
@@ -292,8 +438,39 @@ class HtmlSanitizer:
         if len(text) > max_length:
             text = text[:max_length] + '...'
 
+        self._preview_cache.set(key, text)
         return text
 
 
+def _is_event_handler(name: str) -> bool:
+    """判斷（已小寫的）屬性名是否為 on* 事件處理器，以字符串操作代替正則匹配"""
+    return len(name) > 2 and name.startswith("on") and (name[2].isalnum() or name[2] == "_")
+
+
+def _digest(html: str) -> bytes:
+    """內容摘要，作為緩存鍵（避免緩存中保留大段原文）"""
+    return blake2b(html.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def _merge_tokens(value: Optional[str], extra: str) -> str:
+    """將空白分隔的 token 併入屬性值（已存在的 token 不重複添加）"""
+    tokens = value.split() if value else []
+    for token in extra.split():
+        if token not in tokens:
+            tokens.append(token)
+    return " ".join(tokens)
+
+
+def _merge_nh3_attributes(match: "re.Match") -> str:
+    """在 nh3 輸出的 a / img 標籤中併入 rel / class token（屬性不存在時追加）"""
+    tag, attrs = match.group(1), match.group(2)
+    value_re, name, extra = _NH3_MERGE_ATTRS[tag]
+    found = value_re.search(attrs)
+    if found is None:
+        return f'<{tag}{attrs} {name}="{extra}">'
+    merged = _merge_tokens(found.group(1), extra)
+    return f'<{tag}{attrs[:found.start()]} {name}="{merged}"{attrs[found.end():]}>'
+
+
 # 單例
 html_sanitizer = HtmlSanitizer()
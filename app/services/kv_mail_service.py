@@ -4,11 +4,13 @@ Cloudflare Workers KV 郵件服務
 從 Cloudflare Workers KV 讀取由 Email Worker 存儲的郵件。
 """
 
+import asyncio
 import json
 import time
 import traceback
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional, Dict, Any
 import httpx
 
 from app.config import settings
@@ -16,6 +18,65 @@ from app.models import Mail
 from app.services.log_service import log_service, LogLevel, LogType
 from app.services.cache_service import mail_index_cache, mail_content_cache
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依賴
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson 未安裝時回退到標準庫
+    _json_loads = json.loads
+
+
+@lru_cache(maxsize=4096)
+def _parse_iso(ts: str) -> datetime:
+    """
+    解析 ISO-8601 時間字符串（結果緩存）
+
+    同一封郵件在索引緩存有效期內會被反覆構建，datetime 不可變，可安全共享
+    """
+    return datetime.fromisoformat(ts[:-1] + "+00:00" if ts.endswith("Z") else ts)
+
+
+def _parse_received_at(value: Optional[str]) -> datetime:
+    """解析接收時間，缺失或格式錯誤時使用當前時間"""
+    if not value:
+        return datetime.now()
+    try:
+        return _parse_iso(value)
+    except ValueError:
+        return datetime.now()
+
+
+# KV 郵件數據的 (鍵, 默認值)，兩個解析器共用同一取值方式
+_MAIL_FIELDS = (
+    ("id", "unknown"),
+    ("from", "unknown"),
+    ("to", ""),
+    ("subject", "(No Subject)"),
+    ("content", ""),
+    ("html_content", None),
+)
+
+# 索引摘要：沒有 to 字段，使用 email 字段；content 使用索引中的摘要
+_INDEX_FIELDS = (
+    ("id", "unknown"),
+    ("from", "unknown"),
+    ("email", ""),
+    ("subject", "(No Subject)"),
+    ("content_preview", ""),
+)
+
+
+def _extract_fields(data: Dict[str, Any], fields: tuple) -> tuple:
+    """按字段表批量取值"""
+    return tuple([data.get(key, default) for key, default in fields])
+
 
 class CloudflareKVClient:
     """Cloudflare Workers KV 客戶端"""
@@ -26,13 +87,15 @@ class CloudflareKVClient:
         self._api_token = settings.cf_api_token
         self._headers = {}
         self._base_url = ""
+        # 共享的 HTTP 客戶端（延遲創建），複用到 api.cloudflare.com 的 keep-alive 連接
+        self._client: Optional[httpx.AsyncClient] = None
 
         # 初始化 URL 和 headers
         self._update_base_url()
         self._update_headers()
 
-        # 驗證配置
-        self._validate_config()
+        # 配置驗證延遲到首次使用時（避免啟動時逐個設置字段產生重複的錯誤日誌）
+        self._validated = False
 
     @property
     def account_id(self):
@@ -44,7 +107,7 @@ class CloudflareKVClient:
         """設置 Account ID 並自動更新 base_url"""
         self._account_id = value
         self._update_base_url()
-        self._validate_config()
+        self._invalidate_config()
 
     @property
     def namespace_id(self):
@@ -56,7 +119,7 @@ class CloudflareKVClient:
         """設置 Namespace ID 並自動更新 base_url"""
         self._namespace_id = value
         self._update_base_url()
-        self._validate_config()
+        self._invalidate_config()
 
     @property
     def api_token(self):
@@ -68,7 +131,7 @@ class CloudflareKVClient:
         """設置 API Token 並自動更新 headers"""
         self._api_token = value
         self._update_headers()
-        self._validate_config()
+        self._invalidate_config()
 
     @property
     def base_url(self):
@@ -99,10 +162,40 @@ class CloudflareKVClient:
                 "Content-Type": "application/json",
             }
 
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        獲取共享的 HTTP 客戶端（首次使用或關閉後重新創建）
+
+        安裝 h2 時啟用 HTTP/2，並發的 KV 讀取在同一連接上多路複用
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=_HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(10.0, connect=3.0),
+                limits=httpx.Limits(
+                    max_connections=50, max_keepalive_connections=20, keepalive_expiry=60.0
+                ),
+            )
+        return self._client
+
+    async def aclose(self):
+        """關閉共享的 HTTP 客戶端（應用關閉時調用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _invalidate_config(self):
+        """配置變更後標記為需要重新驗證"""
+        self._validated = False
+
+    def _ensure_validated(self):
+        """首次使用（或配置變更後）驗證一次配置"""
+        if not self._validated:
+            self._validated = True
+            self._validate_config()
+
     def _validate_config(self):
         """驗證配置完整性"""
-        import asyncio
-
         errors = []
         if not self._account_id or not self._account_id.strip():
             errors.append("CF_ACCOUNT_ID is empty")
@@ -112,20 +205,13 @@ class CloudflareKVClient:
             errors.append("CF_API_TOKEN is empty")
 
         if errors:
-            # 異步記錄錯誤（不阻塞初始化）
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(log_service.log(
-                        level=LogLevel.ERROR,
-                        log_type=LogType.KV_ACCESS,
-                        message=f"Cloudflare KV configuration incomplete: {', '.join(errors)}",
-                        details={"errors": errors}
-                    ))
-            except Exception:
-                # 如果沒有事件循環，使用同步日誌
-                import logging
-                logging.error(f"Cloudflare KV configuration incomplete: {', '.join(errors)}")
+            # 非阻塞記錄錯誤
+            log_service.log_nowait(
+                level=LogLevel.ERROR,
+                log_type=LogType.KV_ACCESS,
+                message=f"Cloudflare KV configuration incomplete: {', '.join(errors)}",
+                details={"errors": errors}
+            )
 
     async def fetch_mails(self, email: str, fetch_full_content: bool = False) -> List[Mail]:
         """
@@ -138,10 +224,11 @@ class CloudflareKVClient:
         Returns:
             郵件列表
         """
+        self._ensure_validated()
         start_time = time.time()
 
         try:
-            await log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.INFO,
                 log_type=LogType.KV_ACCESS,
                 message=f"Fetching mails for {email} (full_content={fetch_full_content})",
@@ -166,22 +253,15 @@ class CloudflareKVClient:
 
                 if fetch_full_content:
                     # 批量獲取完整郵件內容（僅在需要時）
-                    for mail_info in mail_list:
-                        mail_key = mail_info.get("key")
-                        if mail_key:
-                            # 先嘗試從緩存獲取
-                            mail_data = mail_content_cache.get(mail_key)
-                            if not mail_data:
-                                # 緩存未命中，從 KV 讀取
-                                mail_data = await self._get_kv_value(mail_key)
-                                if mail_data:
-                                    # 存入緩存 (TTL: 5 分鐘)
-                                    mail_content_cache.set(mail_key, mail_data, ttl=300)
-
-                            if mail_data:
-                                mail = self._parse_mail_data(mail_data)
-                                if mail:
-                                    mails.append(mail)
+                    mail_keys = [info.get("key") for info in mail_list if info.get("key")]
+
+                    contents = await self._get_mail_contents(mail_keys)
+                    for key in mail_keys:
+                        mail_data = contents.get(key)
+                        if mail_data:
+                            mail = self._parse_mail_data(mail_data)
+                            if mail:
+                                mails.append(mail)
                 else:
                     # 直接從索引構建 Mail 對象（優化：減少 KV 讀取）
                     for mail_info in mail_list:
@@ -232,24 +312,35 @@ class CloudflareKVClient:
         start_time = time.time()
 
         try:
-            # 列出所有匹配 prefix 的 key
+            # 分頁列出所有匹配 prefix 的 key；每頁一到即開始並發讀取該頁郵件，
+            # 與下一頁的列表請求重疊
             prefix = f"mail:{email}:"
-            keys = await self._list_keys(prefix)
-
-            await log_service.log(
+            keys_found = 0
+            fetches = []
+            try:
+                async for page in self._iter_key_pages(prefix):
+                    keys_found += len(page)
+                    fetches.append(asyncio.create_task(self._get_mail_contents(page)))
+                pages = await asyncio.gather(*fetches)
+            except BaseException:
+                for task in fetches:
+                    task.cancel()
+                raise
+
+            log_service.log_nowait(
                 level=LogLevel.INFO,
                 log_type=LogType.KV_ACCESS,
                 message=f"Fetching mails by prefix: {prefix}",
-                details={"email": email, "prefix": prefix, "keys_found": len(keys)}
+                details={"email": email, "prefix": prefix, "keys_found": keys_found}
             )
 
             mails = []
-            for key_name in keys:
-                mail_data = await self._get_kv_value(key_name)
-                if mail_data:
-                    mail = self._parse_mail_data(mail_data)
-                    if mail:
-                        mails.append(mail)
+            for page in pages:
+                for mail_data in page.values():
+                    if mail_data:
+                        mail = self._parse_mail_data(mail_data)
+                        if mail:
+                            mails.append(mail)
 
             # 按接收時間排序
             mails.sort(key=lambda m: m.received_at, reverse=True)
@@ -294,24 +385,23 @@ class CloudflareKVClient:
         try:
             url = f"{self.base_url}/values/{key}"
 
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=self.headers)
+            response = await self._get_client().get(url, headers=self.headers)
 
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 404:
-                    return None
-                else:
-                    await log_service.log(
-                        level=LogLevel.WARNING,
-                        log_type=LogType.KV_ACCESS,
-                        message=f"KV GET returned non-200 status: {response.status_code}",
-                        details={"key": key, "status_code": response.status_code}
-                    )
-                    return None
+            if response.status_code == 200:
+                return _json_loads(response.content)
+            elif response.status_code == 404:
+                return None
+            else:
+                log_service.log_nowait(
+                    level=LogLevel.WARNING,
+                    log_type=LogType.KV_ACCESS,
+                    message=f"KV GET returned non-200 status: {response.status_code}",
+                    details={"key": key, "status_code": response.status_code}
+                )
+                return None
 
         except Exception as e:
-            await log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.KV_ACCESS,
                 message=f"Failed to get KV key: {str(e)}",
@@ -323,45 +413,90 @@ class CloudflareKVClient:
             )
             return None
 
-    async def _list_keys(self, prefix: str, limit: int = 20) -> List[str]:
+    async def _get_mail_contents(self, keys: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        批量獲取郵件內容：先從緩存獲取，未命中的 key 並發從 KV 讀取並寫入緩存
+
+        Returns:
+            {key: 郵件數據或 None}，順序與 keys 一致
         """
-        列出匹配 prefix 的所有 key
+        contents = {key: mail_content_cache.get(key) for key in keys}
+        missing = [key for key, data in contents.items() if not data]
+        for key, mail_data in zip(missing, await self._get_kv_values(missing)):
+            if mail_data:
+                # 存入緩存 (TTL: 5 分鐘)
+                mail_content_cache.set(key, mail_data, ttl=300)
+                contents[key] = mail_data
+        return contents
+
+    async def _get_kv_values(self, keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """
+        並發獲取多個 KV 值（共享客戶端複用連接，總耗時約為單次往返）
 
         Args:
-            prefix: key 前綴
-            limit: 最大返回數量 (優化：從 100 降低到 20)
+            keys: KV 鍵名列表
 
         Returns:
-            key 列表
+            與 keys 順序一致的值列表，讀取失敗的項為 None
         """
-        try:
-            url = f"{self.base_url}/keys"
-            params = {"prefix": prefix, "limit": limit}
-
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=self.headers, params=params)
+        if not keys:
+            return []
+        results = await asyncio.gather(
+            *(self._get_kv_value(key) for key in keys), return_exceptions=True
+        )
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+    async def _iter_key_pages(
+        self, prefix: str, page_size: int = 100, max_keys: int = 1000
+    ) -> AsyncIterator[List[str]]:
+        """
+        按 cursor 分頁列出匹配 prefix 的 key
 
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get("success"):
-                        keys = data.get("result", [])
-                        return [k["name"] for k in keys]
+        Args:
+            prefix: key 前綴
+            page_size: 每頁數量
+            max_keys: 最多返回的 key 數量（限制單個郵箱的 KV 讀取成本）
 
-            return []
+        Yields:
+            每頁的 key 列表
+        """
+        cursor = None
+        total = 0
+        try:
+            url = f"{self.base_url}/keys"
+            while total < max_keys:
+                params = {"prefix": prefix, "limit": min(page_size, max_keys - total)}
+                if cursor:
+                    params["cursor"] = cursor
+
+                response = await self._get_client().get(url, headers=self.headers, params=params)
+                if response.status_code != 200:
+                    return
+                data = _json_loads(response.content)
+                if not data.get("success"):
+                    return
+
+                names = [k["name"] for k in data.get("result", [])]
+                if names:
+                    total += len(names)
+                    yield names
+
+                cursor = (data.get("result_info") or {}).get("cursor")
+                if not cursor:
+                    return
 
         except Exception as e:
-            await log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.KV_ACCESS,
                 message=f"Failed to list KV keys: {str(e)}",
                 details={
                     "prefix": prefix,
-                    "limit": limit,
+                    "cursor": cursor,
                     "error_type": type(e).__name__,
                     "error_message": str(e)
                 }
             )
-            return []
 
     def _parse_mail_data(self, data: Dict[str, Any]) -> Optional[Mail]:
         """
@@ -374,36 +509,20 @@ class CloudflareKVClient:
             Mail 對象或 None
         """
         try:
-            # 解析接收時間
-            received_at_str = data.get("received_at")
-            if received_at_str:
-                try:
-                    received_at = datetime.fromisoformat(received_at_str.replace("Z", "+00:00"))
-                except ValueError:
-                    received_at = datetime.now()
-            else:
-                received_at = datetime.now()
-
-            # 構建 Mail 對象
-            mail = Mail(
-                id=data.get("id", "unknown"),
-                email_token="",  # 將在存儲時設置
-                **{
-                    "from": data.get("from", "unknown"),
-                    "to": data.get("to", ""),
-                    "subject": data.get("subject", "(No Subject)"),
-                    "content": data.get("content", ""),
-                    "html_content": data.get("html_content"),
-                    "received_at": received_at,
-                    "read": False,
-                },
+            mail_id, from_, to, subject, content, html_content = _extract_fields(
+                data, _MAIL_FIELDS
+            )
+
+            # 構建 Mail 對象（email_token 將在存儲時設置）
+            mail = Mail.from_kv_fields(
+                mail_id, from_, to, subject, content, html_content,
+                _parse_received_at(data.get("received_at")),
             )
 
             return mail
 
         except Exception as e:
-            import asyncio
-            asyncio.create_task(log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.KV_ACCESS,
                 message=f"Failed to parse mail data: {str(e)}",
@@ -412,7 +531,7 @@ class CloudflareKVClient:
                     "error_message": str(e),
                     "data_keys": list(data.keys()) if isinstance(data, dict) else None
                 }
-            ))
+            )
             return None
 
     def _parse_mail_from_index(self, mail_info: Dict[str, Any]) -> Optional[Mail]:
@@ -426,39 +545,19 @@ class CloudflareKVClient:
             Mail 對象或 None
         """
         try:
-            # 解析接收時間
-            received_at_str = mail_info.get("receivedAt")
-            if received_at_str:
-                try:
-                    received_at = datetime.fromisoformat(received_at_str.replace("Z", "+00:00"))
-                except ValueError:
-                    received_at = datetime.now()
-            else:
-                received_at = datetime.now()
-
             # 從索引構建簡化的 Mail 對象
             # 注意：content 使用 content_preview（從索引獲取），如需完整內容需再讀取
-            content_preview = mail_info.get("content_preview", "")
-
-            mail = Mail(
-                id=mail_info.get("id", "unknown"),
-                email_token="",  # 將在存儲時設置
-                **{
-                    "from": mail_info.get("from", "unknown"),
-                    "to": mail_info.get("email", ""),  # 索引中沒有 to 字段，使用 email 字段
-                    "subject": mail_info.get("subject", "(No Subject)"),
-                    "content": content_preview,  # 使用索引中的摘要
-                    "html_content": None,
-                    "received_at": received_at,
-                    "read": False,
-                },
+            mail_id, from_, to, subject, content = _extract_fields(mail_info, _INDEX_FIELDS)
+
+            mail = Mail.from_kv_fields(
+                mail_id, from_, to, subject, content, None,
+                _parse_received_at(mail_info.get("receivedAt")),
             )
 
             return mail
 
         except Exception as e:
-            import asyncio
-            asyncio.create_task(log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.KV_ACCESS,
                 message=f"Failed to parse mail from index: {str(e)}",
@@ -467,7 +566,7 @@ class CloudflareKVClient:
                     "error_message": str(e),
                     "mail_info_keys": list(mail_info.keys()) if isinstance(mail_info, dict) else None
                 }
-            ))
+            )
             return None
 
     async def test_connection(self) -> bool:
@@ -477,22 +576,24 @@ class CloudflareKVClient:
         Returns:
             是否連接成功
         """
+        self._ensure_validated()
         try:
             url = f"{self.base_url}/keys"
             params = {"limit": 1}
 
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(url, headers=self.headers, params=params)
-                success = response.status_code == 200
+            response = await self._get_client().get(
+                url, headers=self.headers, params=params, timeout=5.0
+            )
+            success = response.status_code == 200
 
-                await log_service.log(
-                    level=LogLevel.SUCCESS if success else LogLevel.ERROR,
-                    log_type=LogType.KV_ACCESS,
-                    message=f"KV connection test: {'success' if success else 'failed'}",
-                    details={"status_code": response.status_code}
-                )
+            await log_service.log(
+                level=LogLevel.SUCCESS if success else LogLevel.ERROR,
+                log_type=LogType.KV_ACCESS,
+                message=f"KV connection test: {'success' if success else 'failed'}",
+                details={"status_code": response.status_code}
+            )
 
-                return success
+            return success
 
         except Exception as e:
             await log_service.log(
@@ -513,29 +614,29 @@ class CloudflareKVClient:
         Returns:
             統計信息字典
         """
+        self._ensure_validated()
         try:
             # 獲取所有 key（用於統計）
             url = f"{self.base_url}/keys"
             params = {"limit": 1000}
 
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url, headers=self.headers, params=params)
+            response = await self._get_client().get(url, headers=self.headers, params=params)
 
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get("success"):
-                        keys = data.get("result", [])
+            if response.status_code == 200:
+                data = _json_loads(response.content)
+                if data.get("success"):
+                    keys = data.get("result", [])
 
-                        # 統計不同類型的 key
-                        mail_keys = [k for k in keys if k["name"].startswith("mail:")]
-                        index_keys = [k for k in keys if k["name"].startswith("index:")]
+                    # 統計不同類型的 key
+                    mail_keys = [k for k in keys if k["name"].startswith("mail:")]
+                    index_keys = [k for k in keys if k["name"].startswith("index:")]
 
-                        return {
-                            "total_keys": len(keys),
-                            "mail_keys": len(mail_keys),
-                            "index_keys": len(index_keys),
-                            "connected": True,
-                        }
+                    return {
+                        "total_keys": len(keys),
+                        "mail_keys": len(mail_keys),
+                        "index_keys": len(index_keys),
+                        "connected": True,
+                    }
 
             return {"connected": False}
 
@@ -3,16 +3,276 @@
 使用 OpenAI API 來智能提取驗證碼
 """
 
+import asyncio
+import hashlib
+import html as _html_mod
 import json
 import re
 import time
 import traceback
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from operator import itemgetter
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
 from app.models import Code
 import httpx
 from app.config import settings
+from app.services.cache_service import LRUCache
+from app.services.code_service import code_service, html_to_text, may_contain_digits
 from app.services.log_service import log_service, LogLevel, LogType
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依賴
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson 未安裝時回退到標準庫
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# 流式回覆的最大累積字符數（防禦性上限）
+_MAX_STREAM_CHARS = 8192
+
+# 單封郵件回覆最多只含一個驗證碼的 JSON，約 40 token，留出餘量
+_MAX_COMPLETION_TOKENS = 100
+
+# 送入提示詞的郵件正文最大字符數
+_PROMPT_TEXT_LIMIT = 2000
+
+# 長正文按關鍵詞截取窗口的關鍵詞（小寫）；英文關鍵詞需完整成詞（排除 barcode/decode 等）
+# 不含 "pin"：它常作為 shipping/shopping 等普通單詞的一部分出現
+_CODE_KEYWORDS = ("code", "verification", "otp", "token", "驗證碼", "验证码")
+
+# 至少含一個數字的 4 位以上字母數字串；整段文本都沒有時不值得調用 LLM
+# 邊界用字母數字環視而非 \b：\b 在中文字符與數字之間不成立（如 "验证码是123456"）
+_LIKELY_CODE_RE = re.compile(r"(?<![A-Za-z0-9])(?=[A-Za-z]*\d)[A-Za-z0-9]{4,}(?![A-Za-z0-9])")
+
+# 連續空白（壓縮後可節省提示詞 token）
+_WHITESPACE_RUN_RE = re.compile(r"\s{2,}")
+
+# LLM 結果緩存有效期（秒）：相同正文與模型的結果不會變化，7 天
+_RESPONSE_CACHE_TTL = 7 * 24 * 3600
+
+# 觸發退避重試的狀態碼與各次重試前的等待秒數
+_RETRY_STATUS_CODES = frozenset((429, 503))
+_RETRY_DELAYS = (1.0, 2.0, 4.0)
+
+# 批量提取：單次請求的最大郵件數與每封郵件的最大字符數
+_BATCH_MAX_EMAILS = 10
+_BATCH_TEXT_LIMIT = 1500
+
+# LLM 返回的驗證碼類型白名單
+_CODE_TYPES = frozenset(("numeric", "alphanumeric", "token"))
+
+_BY_RANK = itemgetter(0)
+
+_SYSTEM_PROMPT = (
+    "You are a verification code extraction expert. Extract exactly ONE most likely "
+    "verification code (OTP/PIN/token) from email content. Return a JSON object "
+    '{"result": [...]} whose array has at most 1 item. If no clear code, return '
+    '{"result": []}. No explanations or markdown.'
+)
+
+_BATCH_SYSTEM_PROMPT = (
+    "You are a verification code extraction expert. The user sends a JSON object "
+    '{"emails": [{"id": <int>, "text": <string>}, ...]}. For EACH email, extract exactly ONE '
+    "most likely verification code (OTP/PIN/token), preferring codes near keywords such as "
+    '"code", "verification", "OTP", "PIN", "驗證碼", "验证码". Never extract years, phone '
+    "numbers, prices, dates or ordinary words. Respond with a JSON object "
+    '{"results": [{"id": <int>, "code": <string>, "type": "numeric"|"alphanumeric"|"token", '
+    '"length": <int>, "confidence": <0.0-1.0>}]} and omit emails without a clear code. '
+    "No explanations or markdown."
+)
+
+# 固定的 system 消息（每次請求復用同一對象）
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+_BATCH_SYSTEM_MESSAGE = {"role": "system", "content": _BATCH_SYSTEM_PROMPT}
+
+# 模型列表請求超時（覆蓋共享客戶端的默認超時）
+_MODELS_TIMEOUT = httpx.Timeout(10.0)
+
+# 單封郵件提示詞：固定前綴（規則說明）+ 郵件正文 + 固定後綴
+_PROMPT_PREFIX = """You are an expert at extracting verification codes from emails. Analyze the email given at the end and extract ONLY the SINGLE MOST LIKELY verification code (OTP/PIN/token). Do not list multiple results.
+
+SELECTION RULES (choose 1 best):
+1. **Numeric codes**: Pure numbers (e.g., 123456, 4567, 87654321)
+   - Common lengths: 4, 6, or 8 digits
+   - Usually near keywords: "code", "verification", "OTP", "PIN", "驗證碼", "验证码"
+   - Prefer 6-digit numeric if equally plausible
+
+2. **Alphanumeric codes**: Mix of letters and numbers (e.g., ABC123, XYZ789)
+   - Usually 6-10 characters
+   - Often capitalized
+
+3. **Tokens**: Long authentication strings (e.g., eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9)
+   - Usually 20+ characters
+   - May contain hyphens or underscores
+   - Often in URLs or after "token:" keyword
+   - Only choose if context explicitly indicates it's the verification code
+
+CONFIDENCE SCORING (for the single choice):
+- 0.95-1.0: Code with explicit keywords (e.g., "Your code is 123456", "驗證碼：123456")
+- 0.85-0.94: Code in URL parameters (e.g., ?code=ABC123, &token=xyz)
+- 0.80-0.84: Standalone numbers/codes in appropriate context (e.g., email body with verification theme)
+- 0.70-0.79: Ambiguous matches that could be codes
+
+AVOID EXTRACTING:
+- Years (e.g., 2024, 2025)
+- Phone numbers
+- Prices or quantities
+- Regular English words (e.g., "below", "Hello", "within")
+- Dates or times
+
+OUTPUT CONSTRAINTS:
+- Return a JSON object whose "result" array has at most 1 item (0 or 1).
+- No markdown or explanations.
+
+SINGLE-ITEM JSON EXAMPLE:
+{"result": [{"code": "123456", "type": "numeric", "length": 6, "confidence": 0.95}]}
+
+If no verification codes found or uncertain, return: {"result": []}
+
+EMAIL CONTENT:
+---
+"""
+_PROMPT_SUFFIX = """
+---
+
+JSON Response:"""
+
+
+def _has_code_candidate(text: str) -> bool:
+    """文本中是否存在可能的驗證碼片段（含數字的 4 位以上字母數字串）"""
+    if not text or not may_contain_digits(text):
+        return False
+    return _LIKELY_CODE_RE.search(text) is not None
+
+
+def _find_keyword(lowered: str, keyword: str, end: int) -> int:
+    """在 lowered[:end] 中查找關鍵詞首次成詞出現的位置，找不到返回 -1"""
+    bounded = keyword.isascii()
+    index = lowered.find(keyword, 0, end)
+    while index != -1:
+        after = index + len(keyword)
+        if not bounded or (
+            (index == 0 or not lowered[index - 1].isalnum())
+            and (after == len(lowered) or not lowered[after].isalnum())
+        ):
+            return index
+        index = lowered.find(keyword, index + 1, end)
+    return -1
+
+
+def _keyword_window(text: str, limit: int) -> str:
+    """
+    長正文只截取第一個驗證碼關鍵詞附近、寬 limit 個字符的窗口（以關鍵詞為中心，貼合正文邊界）
+
+    正文不超過 limit 時原樣返回；找不到關鍵詞時回退到前 limit 個字符
+    """
+    length = len(text)
+    if length <= limit:
+        return text
+
+    # 找到一個命中後，後續關鍵詞只需在該位置之前查找（只關心最早出現者）
+    lowered = text.lower()
+    first = length
+    for keyword in _CODE_KEYWORDS:
+        index = _find_keyword(lowered, keyword, first + len(keyword) - 1)
+        if index != -1:
+            first = index
+    if first == length:
+        return text[:limit]
+    start = min(max(0, first - limit // 2), length - limit)
+    return text[start:start + limit]
+
+
+def _prompt_snippet(text: str, limit: int) -> str:
+    """截取送入提示詞的正文片段，解碼 HTML 實體並壓縮連續空白以節省 token"""
+    snippet = _keyword_window(text, limit)
+    if "&" in snippet:
+        snippet = _html_mod.unescape(snippet)
+    return _WHITESPACE_RUN_RE.sub(" ", snippet)
+
+
+def _slice_json_array(content: str) -> Optional[str]:
+    """
+    截取第一個 "[" 到最後一個 "]" 之間的片段（去掉前後說明文字或 markdown 圍欄）
+
+    與貪婪正則 r'\[[\s\S]*\]' 結果相同，但只需兩次 C 層級的線性掃描
+    """
+    start = content.find("[")
+    if start == -1:
+        return None
+    end = content.rfind("]")
+    if end < start:
+        return None
+    return content[start:end + 1]
+
+
+class _CircuitBreaker:
+    """
+    LLM 調用斷路器（關閉 / 打開 / 半開）
+
+    連續失敗達到閾值後打開，冷卻期內直接拒絕調用；冷卻期結束進入半開狀態，
+    只放行一個探測請求：成功則關閉，失敗則重新打開
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+    def allow(self) -> bool:
+        """是否允許發起 LLM 調用"""
+        if self.state == self.CLOSED:
+            return True
+
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.cooldown:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+
+        # 半開：同一時間只放行一個探測請求（探測請求被取消未回報時，超過冷卻期後重新放行）
+        if self._probe_started is not None and now - self._probe_started < self.cooldown:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self):
+        """記錄一次成功調用，斷路器回到關閉狀態"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self) -> bool:
+        """記錄一次失敗調用；本次失敗導致斷路器打開時返回 True"""
+        self._probe_started = None
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED and self.failures >= self.failure_threshold
+        ):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
 
 class LLMCodeService:
     """使用 LLM 進行智能驗證碼提取"""
@@ -22,11 +282,95 @@ class LLMCodeService:
         self.api_base = settings.openai_api_base or "https://api.openai.com/v1"
         self.model = settings.openai_model or "gpt-3.5-turbo"
         self.use_llm = settings.use_llm_extraction and bool(self.api_key)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._headers: Dict[str, str] = {}
+        self._headers_key: Optional[str] = None
+        # LLM 提取結果緩存（低溫度下結果可視為確定性，相同正文直接復用）
+        self._response_cache = LRUCache(maxsize=2048, ttl=_RESPONSE_CACHE_TTL)
+        # 否定結果緩存（LLM 判定無驗證碼）：營銷郵件常重複出現，容量更大
+        self._negative_cache = LRUCache(maxsize=4096, ttl=_RESPONSE_CACHE_TTL)
+        self.cache_stats = {
+            "hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "skipped_by_regex": 0,
+            "short_circuited": 0,
+        }
+        # 並發上限：突發郵件時避免大量請求同時打到 API（觸發限流或連接池耗盡）
+        self._sem = asyncio.Semaphore(max(1, settings.llm_max_concurrency))
+        self._inflight = 0
+
+        # 並發請求合併：窗口期內到達的 extract_codes 調用合併為一次批量請求
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._batch_dispatcher: Optional[asyncio.Task] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+        # 每個 (api_base, model) 一個斷路器：API 故障時快速回退到正則，不再等待超時
+        self._breakers: Dict[Tuple[str, str], _CircuitBreaker] = {}
 
         # 始終初始化回退服務
-        from app.services.code_service import code_service
         self.fallback_service = code_service
 
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        獲取共享的 HTTP 客戶端（首次使用或關閉後重新創建）
+
+        長連接復用 TCP/TLS 會話，避免每次提取都重新握手
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=_HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(30.0, connect=5.0),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            )
+        return self._client
+
+    async def aclose(self):
+        """關閉共享的 HTTP 客戶端（應用關閉時調用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _auth_headers(self, api_key: str) -> Dict[str, str]:
+        """請求頭（按 API Key 緩存，Key 在運行時被修改後自動重建）"""
+        if self._headers_key != api_key:
+            self._headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            }
+            self._headers_key = api_key
+        return self._headers
+
+    def get_inflight(self) -> int:
+        """當前正在進行的 LLM 請求數"""
+        return self._inflight
+
+    @asynccontextmanager
+    async def _chat_completion(self, body: dict) -> AsyncIterator[httpx.Response]:
+        """
+        發起 chat/completions 請求並返回未讀取的響應（流式）
+
+        請求期間佔用一個並發名額；遇到 429/503 時釋放名額，按 _RETRY_DELAYS 退避後重試，
+        重試用盡後返回最後一次的響應，由調用方處理錯誤狀態
+        """
+        for delay in (*_RETRY_DELAYS, None):
+            async with self._sem:
+                self._inflight += 1
+                try:
+                    async with self._get_client().stream(
+                        "POST",
+                        f"{self.api_base}/chat/completions",
+                        headers=self._auth_headers(self.api_key),
+                        content=_json_dumps(body),
+                    ) as response:
+                        if delay is None or response.status_code not in _RETRY_STATUS_CODES:
+                            yield response
+                            return
+                finally:
+                    self._inflight -= 1
+            await asyncio.sleep(delay)
+
     async def get_available_models(self, api_base: str = None, api_key: str = None) -> dict:
         """
         從 API 端點獲取可用的模型列表
@@ -65,80 +409,77 @@ class LLMCodeService:
             )
 
             # 嘗試調用 /v1/models 端點（OpenAI 標準）
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{base_url}/models",
-                    headers={
-                        "Authorization": f"Bearer {key}",
-                        "Content-Type": "application/json",
-                    }
-                )
+            response = await self._get_client().get(
+                f"{base_url}/models",
+                headers=self._auth_headers(key),
+                timeout=_MODELS_TIMEOUT,
+            )
 
-                if response.status_code == 200:
-                    data = response.json()
-
-                    # 解析模型列表（支持多種格式）
-                    models = []
-                    if isinstance(data, dict):
-                        # OpenAI 格式：{"data": [{"id": "gpt-3.5-turbo"}, ...], "object": "list"}
-                        if "data" in data and isinstance(data["data"], list):
-                            models = [
-                                item["id"] if isinstance(item, dict) and "id" in item else str(item)
-                                for item in data["data"]
-                            ]
-                        # 簡單格式：{"models": ["model1", "model2"]}
-                        elif "models" in data and isinstance(data["models"], list):
-                            models = data["models"]
-                        # 其他可能的格式
-                        elif "model_list" in data and isinstance(data["model_list"], list):
-                            models = data["model_list"]
-                    # 直接返回列表
-                    elif isinstance(data, list):
+            if response.status_code == 200:
+                data = response.json()
+
+                # 解析模型列表（支持多種格式）
+                models = []
+                if isinstance(data, dict):
+                    # OpenAI 格式：{"data": [{"id": "gpt-3.5-turbo"}, ...], "object": "list"}
+                    if "data" in data and isinstance(data["data"], list):
                         models = [
                             item["id"] if isinstance(item, dict) and "id" in item else str(item)
-                            for item in data
+                            for item in data["data"]
                         ]
+                    # 簡單格式：{"models": ["model1", "model2"]}
+                    elif "models" in data and isinstance(data["models"], list):
+                        models = data["models"]
+                    # 其他可能的格式
+                    elif "model_list" in data and isinstance(data["model_list"], list):
+                        models = data["model_list"]
+                # 直接返回列表
+                elif isinstance(data, list):
+                    models = [
+                        item["id"] if isinstance(item, dict) and "id" in item else str(item)
+                        for item in data
+                    ]
+
+                # 過濾和排序
+                models = [m for m in models if m and isinstance(m, str)]
+                models.sort()
 
-                    # 過濾和排序
-                    models = [m for m in models if m and isinstance(m, str)]
-                    models.sort()
-
-                    await log_service.log(
-                        level=LogLevel.SUCCESS,
-                        log_type=LogType.LLM_CALL,
-                        message=f"成功獲取 {len(models)} 個模型",
-                        details={
-                            "api_base": base_url,
-                            "models_count": len(models)
-                        }
-                    )
-
-                    return {
-                        "success": True,
-                        "models": models,
-                        "message": f"成功獲取 {len(models)} 個模型",
-                        "source": "api"
+                await log_service.log(
+                    level=LogLevel.SUCCESS,
+                    log_type=LogType.LLM_CALL,
+                    message=f"成功獲取 {len(models)} 個模型",
+                    details={
+                        "api_base": base_url,
+                        "models_count": len(models)
                     }
-                else:
-                    error_msg = f"API 返回错误: {response.status_code}"
+                )
 
-                    await log_service.log(
-                        level=LogLevel.WARNING,
-                        log_type=LogType.LLM_CALL,
-                        message=error_msg,
-                        details={
-                            "status_code": response.status_code,
-                            "response_text": response.text[:500],
-                            "api_base": base_url
-                        }
-                    )
+                return {
+                    "success": True,
+                    "models": models,
+                    "message": f"成功獲取 {len(models)} 個模型",
+                    "source": "api"
+                }
+            else:
+                error_msg = f"API 返回错误: {response.status_code}"
 
-                    return {
-                        "success": False,
-                        "models": [],
-                        "message": error_msg,
-                        "source": "error"
+                await log_service.log(
+                    level=LogLevel.WARNING,
+                    log_type=LogType.LLM_CALL,
+                    message=error_msg,
+                    details={
+                        "status_code": response.status_code,
+                        "response_text": response.text[:500],
+                        "api_base": base_url
                     }
+                )
+
+                return {
+                    "success": False,
+                    "models": [],
+                    "message": error_msg,
+                    "source": "error"
+                }
 
         except httpx.TimeoutException:
             error_msg = "獲取模型列表超時（10秒）"
@@ -187,9 +528,37 @@ class LLMCodeService:
         if not self.use_llm:
             return self.fallback_service.extract_codes(text)
 
+        # 沒有任何候選片段時跳過 LLM，直接使用正則結果（省去一次網絡往返）
+        if not _has_code_candidate(text):
+            return self.fallback_service.extract_codes(text)
+
+        key = self._cache_key(text)
+        cached = self._cached_codes(key)
+        if cached is not None:
+            return cached
+
+        # 正則已找到高信心驗證碼時無需再調用 LLM
+        regex_codes = self._confident_regex_codes(text)
+        if regex_codes is not None:
+            return regex_codes
+
+        return await self._extract_uncached(text, key)
+
+    async def _extract_uncached(self, text: str, key: str) -> List[Code]:
+        """緩存未命中時調用 LLM 提取（受斷路器保護），成功後寫入緩存；失敗時回退到正則"""
+        # 斷路器打開時不調用 LLM
+        breaker = self._breaker()
+        if settings.circuit_breaker_enabled and not breaker.allow():
+            self.cache_stats["short_circuited"] += 1
+            return self.fallback_service.extract_codes(text)
+
         try:
-            return await self._extract_with_llm(text)
+            if settings.llm_batch_window_ms > 0:
+                codes = await self._extract_coalesced(text)
+            else:
+                codes = await self._extract_with_llm(text)
         except Exception as e:
+            self._record_failure(breaker, e)
             await log_service.log(
                 level=LogLevel.WARNING,
                 log_type=LogType.CODE_EXTRACT,
@@ -202,6 +571,295 @@ class LLMCodeService:
             )
             return self.fallback_service.extract_codes(text)
 
+        self._record_success(breaker)
+        self._store_codes(key, codes)
+        return codes
+
+    def _cached_codes(self, key: str) -> Optional[List[Code]]:
+        """查詢 LLM 結果緩存：命中時返回驗證碼（無驗證碼的結果為空列表），未命中返回 None"""
+        cached = self._response_cache.get(key)
+        if cached is not None:
+            self.cache_stats["hits"] += 1
+            return list(cached)
+        if self._negative_cache.get(key) is not None:
+            self.cache_stats["negative_hits"] += 1
+            return []
+        self.cache_stats["misses"] += 1
+        return None
+
+    def _store_codes(self, key: str, codes: List[Code]):
+        """緩存成功解析的 LLM 結果（空結果寫入負緩存）"""
+        if codes:
+            self._response_cache.set(key, codes)
+        else:
+            self._negative_cache.set(key, True)
+
+    def _confident_regex_codes(self, text: str) -> Optional[List[Code]]:
+        """
+        正則恰好找到一個信心值不低於 llm_skip_threshold 的驗證碼時返回該驗證碼
+        （與 LLM 路徑一樣只返回一個）；否則返回 None（需調用 LLM）
+
+        默認閾值只有關鍵詞上下文命中（0.95）才能達到，裸數字（如訂單號）不會跳過 LLM；
+        純字母的匹配（如 "Your code is" 中的 "code"）多為普通單詞，不作為跳過 LLM 的依據
+        """
+        threshold = settings.llm_skip_threshold
+        confident = {
+            code.code: code
+            for code in self.fallback_service.extract_codes(text)
+            if code.confidence >= threshold and not code.code.isalpha()
+        }
+        if len(confident) != 1:
+            return None
+        self.cache_stats["skipped_by_regex"] += 1
+        return list(confident.values())
+
+    def _breaker(self) -> _CircuitBreaker:
+        """當前 API 端點與模型對應的斷路器"""
+        key = (self.api_base, self.model)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = _CircuitBreaker(
+                settings.circuit_breaker_threshold, settings.circuit_breaker_timeout
+            )
+            self._breakers[key] = breaker
+        return breaker
+
+    def _record_success(self, breaker: _CircuitBreaker):
+        """記錄 LLM 調用成功（斷路器停用時不記錄）"""
+        if settings.circuit_breaker_enabled:
+            breaker.record_success()
+
+    def _record_failure(self, breaker: _CircuitBreaker, error: Exception):
+        """記錄 LLM 調用失敗（斷路器停用時不記錄）；斷路器因此打開時記錄警告"""
+        if settings.circuit_breaker_enabled and breaker.record_failure():
+            log_service.log_nowait(
+                level=LogLevel.WARNING,
+                log_type=LogType.LLM_CALL,
+                message=f"LLM circuit breaker opened, using regex for {breaker.cooldown}s",
+                details={
+                    "api_base": self.api_base,
+                    "model": self.model,
+                    "failures": breaker.failures,
+                    "cooldown_seconds": breaker.cooldown,
+                    "last_error": f"{type(error).__name__}: {error}"
+                }
+            )
+
+    def _cache_key(self, text: str) -> str:
+        """LLM 結果緩存鍵：模型名稱 + 實際送入提示詞的正文片段的 SHA-256"""
+        snippet = _prompt_snippet(text, _PROMPT_TEXT_LIMIT).strip()
+        payload = f"{self.model}|{snippet}".encode("utf-8", "surrogatepass")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_cache_stats(self) -> dict:
+        """獲取 LLM 結果緩存統計信息（含跳過 LLM 的次數與斷路器狀態）"""
+        return {
+            "entries": len(self._response_cache),
+            "negative_entries": len(self._negative_cache),
+            "hits": self.cache_stats["hits"],
+            "negative_hits": self.cache_stats["negative_hits"],
+            "misses": self.cache_stats["misses"],
+            "skipped_by_regex": self.cache_stats["skipped_by_regex"],
+            "short_circuited": self.cache_stats["short_circuited"],
+            "breaker_state": self._breaker().state,
+        }
+
+    async def extract_codes_batch(self, texts: List[str]) -> List[List[Code]]:
+        """
+        批量提取多封郵件的驗證碼（一次 LLM 請求處理多封郵件，分攤網絡往返與提示詞開銷）
+
+        返回與 texts 一一對應的結果；無候選片段的郵件直接使用正則結果，
+        與 extract_codes 共用結果緩存，批量請求失敗時逐封調用 LLM
+        """
+        if not self.use_llm:
+            return [self.fallback_service.extract_codes(text) for text in texts]
+
+        results: List[List[Code]] = [[] for _ in texts]
+        keys: Dict[int, str] = {}
+        pending: List[int] = []
+        for index, text in enumerate(texts):
+            if not _has_code_candidate(text):
+                results[index] = self.fallback_service.extract_codes(text)
+                continue
+            key = self._cache_key(text)
+            cached = self._cached_codes(key)
+            if cached is not None:
+                results[index] = cached
+                continue
+            regex_codes = self._confident_regex_codes(text)
+            if regex_codes is not None:
+                results[index] = regex_codes
+            else:
+                keys[index] = key
+                pending.append(index)
+
+        for start in range(0, len(pending), _BATCH_MAX_EMAILS):
+            chunk = pending[start:start + _BATCH_MAX_EMAILS]
+            if len(chunk) == 1:
+                results[chunk[0]] = await self._extract_uncached(texts[chunk[0]], keys[chunk[0]])
+                continue
+
+            breaker = self._breaker()
+            if settings.circuit_breaker_enabled and not breaker.allow():
+                self.cache_stats["short_circuited"] += len(chunk)
+                for i in chunk:
+                    results[i] = self.fallback_service.extract_codes(texts[i])
+                continue
+
+            try:
+                batch = await self._extract_batch_with_llm({i: texts[i] for i in chunk})
+            except Exception as e:
+                self._record_failure(breaker, e)
+                log_service.log_nowait(
+                    level=LogLevel.WARNING,
+                    log_type=LogType.CODE_EXTRACT,
+                    message=f"LLM batch extraction failed, falling back to per-email: {str(e)}",
+                    details={
+                        "error_type": type(e).__name__,
+                        "error_message": str(e),
+                        "batch_size": len(chunk),
+                        "fallback": "per_email"
+                    }
+                )
+                for i in chunk:
+                    results[i] = await self._extract_uncached(texts[i], keys[i])
+                continue
+
+            self._record_success(breaker)
+            for i in chunk:
+                results[i] = batch.get(i, [])
+                self._store_codes(keys[i], results[i])
+
+        return results
+
+    async def _extract_coalesced(self, text: str) -> List[Code]:
+        """將單封郵件的 LLM 提取放入合併隊列，等待後台調度器返回結果"""
+        loop = asyncio.get_running_loop()
+        # 隊列與事件循環綁定，事件循環變化（如重啟）時重新創建
+        if self._batch_queue is None or self._batch_loop is not loop:
+            self._batch_queue = asyncio.Queue()
+            self._batch_loop = loop
+            self._batch_dispatcher = None
+        if self._batch_dispatcher is None or self._batch_dispatcher.done():
+            self._batch_dispatcher = asyncio.create_task(
+                self._dispatch_batches(self._batch_queue)
+            )
+
+        future = loop.create_future()
+        self._batch_queue.put_nowait((text, future))
+        return await future
+
+    async def _dispatch_batches(self, queue: asyncio.Queue):
+        """後台任務：收集窗口期內的請求（最多 _BATCH_MAX_EMAILS 封），合併後交給批量提取"""
+        loop = asyncio.get_running_loop()
+        window = settings.llm_batch_window_ms / 1000
+        while True:
+            items = [await queue.get()]
+            deadline = loop.time() + window
+            while len(items) < _BATCH_MAX_EMAILS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # 批量請求在獨立任務中進行，調度器立即開始收集下一批
+            task = asyncio.create_task(self._resolve_batch(items))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _resolve_batch(self, items: List[Tuple[str, asyncio.Future]]):
+        """執行一批合併的提取並回填各調用方的 Future；批量失敗時逐封調用 LLM"""
+        items = [(text, future) for text, future in items if not future.done()]
+        if not items:
+            return
+
+        if len(items) > 1:
+            try:
+                batch = await self._extract_batch_with_llm(
+                    {index: text for index, (text, _) in enumerate(items)}
+                )
+            except Exception:
+                batch = None
+            if batch is not None:
+                for index, (_, future) in enumerate(items):
+                    if not future.done():
+                        future.set_result(batch.get(index, []))
+                return
+
+        results = await asyncio.gather(
+            *(self._extract_with_llm(text) for text, _ in items), return_exceptions=True
+        )
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _extract_batch_with_llm(self, emails: Dict[int, str]) -> Dict[int, List[Code]]:
+        """單次請求提取多封郵件的驗證碼（JSON mode），返回 {郵件序號: 驗證碼列表}"""
+        start_time = time.time()
+        payload = {
+            "emails": [
+                {"id": index, "text": _prompt_snippet(text, _BATCH_TEXT_LIMIT)}
+                for index, text in emails.items()
+            ]
+        }
+
+        async with self._chat_completion({
+            "model": self.model,
+            "messages": [
+                _BATCH_SYSTEM_MESSAGE,
+                {"role": "user", "content": _json_dumps(payload).decode("utf-8")}
+            ],
+            "temperature": 0.1,
+            "max_tokens": 100 * len(emails),
+            "response_format": {"type": "json_object"},
+        }) as response:
+            body = await response.aread()
+
+        if response.status_code != 200:
+            raise Exception(f"API 調用失敗: {response.status_code} - {response.text[:500]}")
+
+        content = _json_loads(body)["choices"][0]["message"]["content"]
+        data = _json_loads(content) if content else {}
+        items = data.get("results") if isinstance(data, dict) else None
+        if not isinstance(items, list):
+            raise ValueError("LLM batch response missing 'results' array")
+
+        # 按郵件序號分組後複用單封郵件的選擇規則
+        grouped: Dict[int, list] = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if index in emails:
+                grouped.setdefault(index, []).append(item)
+
+        codes = {index: self._select_best(group) for index, group in grouped.items()}
+
+        log_service.log_nowait(
+            level=LogLevel.SUCCESS,
+            log_type=LogType.LLM_CALL,
+            message=f"Successfully extracted codes for {len(codes)}/{len(emails)} emails "
+                    f"with one LLM batch",
+            details={
+                "model": self.model,
+                "batch_size": len(emails),
+                "emails_with_codes": len(codes)
+            },
+            duration_ms=(time.time() - start_time) * 1000
+        )
+
+        return codes
+
     async def _extract_with_llm(self, text: str) -> List[Code]:
         """使用 LLM 提取驗證碼"""
         start_time = time.time()
@@ -221,52 +879,44 @@ class LLMCodeService:
                 }
             )
 
-            # 調用 OpenAI API
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are a verification code extraction expert. Extract exactly ONE most likely verification code (OTP/PIN/token) from email content. Return JSON array with at most 1 item. If no clear code, return []. No explanations or markdown."
-                            },
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ],
-                        "temperature": 0.1,  # 低溫度以獲得更確定的結果
-                        "max_tokens": 500,
+            # 調用 OpenAI API（流式返回，完整 JSON 陣列到達即可停止讀取）
+            async with self._chat_completion({
+                "model": self.model,
+                "messages": [
+                    _SYSTEM_MESSAGE,
+                    {
+                        "role": "user",
+                        "content": prompt
                     }
-                )
+                ],
+                "temperature": 0.1,  # 低溫度以獲得更確定的結果
+                "max_tokens": _MAX_COMPLETION_TOKENS,
+                "response_format": {"type": "json_object"},
+                "stream": True,
+            }) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    error_msg = f"API 調用失敗: {response.status_code} - {response.text}"
 
-            if response.status_code != 200:
-                error_msg = f"API 調用失敗: {response.status_code} - {response.text}"
-
-                await log_service.log(
-                    level=LogLevel.ERROR,
-                    log_type=LogType.LLM_CALL,
-                    message=error_msg,
-                    details={
-                        "status_code": response.status_code,
-                        "response_text": response.text[:500],
-                        "model": self.model
-                    }
-                )
+                    await log_service.log(
+                        level=LogLevel.ERROR,
+                        log_type=LogType.LLM_CALL,
+                        message=error_msg,
+                        details={
+                            "status_code": response.status_code,
+                            "response_text": response.text[:500],
+                            "model": self.model
+                        }
+                    )
 
-                raise Exception(error_msg)
+                    raise Exception(error_msg)
 
-            result = response.json()
-            content = result["choices"][0]["message"]["content"]
+                content = await self._read_completion(response)
 
-            # 解析 LLM 返回的 JSON
+            # 解析 LLM 返回的 JSON；無法解析（含被截斷的流）視為調用失敗，不作為「無驗證碼」緩存
             codes = self._parse_llm_response(content)
+            if codes is None:
+                raise ValueError("LLM response contains no parseable JSON array")
 
             duration_ms = (time.time() - start_time) * 1000
             await log_service.log(
@@ -285,7 +935,7 @@ class LLMCodeService:
 
         except httpx.TimeoutException as e:
             duration_ms = (time.time() - start_time) * 1000
-            await log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.LLM_CALL,
                 message=f"LLM API timeout: {str(e)}",
@@ -300,147 +950,98 @@ class LLMCodeService:
 
         except Exception as e:
             duration_ms = (time.time() - start_time) * 1000
-            await log_service.log(
+            details = {
+                "error_type": type(e).__name__,
+                "error_message": str(e),
+                "model": self.model
+            }
+            # 完整堆棧僅在詳細日誌模式下格式化；錯誤路徑不等待日誌寫入
+            if settings.debug_email_fetch:
+                details["traceback"] = traceback.format_exc()
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.LLM_CALL,
                 message=f"LLM extraction error: {str(e)}",
-                details={
-                    "error_type": type(e).__name__,
-                    "error_message": str(e),
-                    "traceback": traceback.format_exc(),
-                    "model": self.model
-                },
+                details=details,
                 duration_ms=duration_ms
             )
             raise
 
-    def _build_prompt(self, text: str) -> str:
-        """構建 LLM 提示詞（限定只返回最有把握的一個）"""
-        return f"""You are an expert at extracting verification codes from emails. Analyze the following email and extract ONLY the SINGLE MOST LIKELY verification code (OTP/PIN/token). Do not list multiple results.
-
-EMAIL CONTENT:
----
-{text[:2000]}
----
-
-SELECTION RULES (choose 1 best):
-1. **Numeric codes**: Pure numbers (e.g., 123456, 4567, 87654321)
-   - Common lengths: 4, 6, or 8 digits
-   - Usually near keywords: "code", "verification", "OTP", "PIN", "驗證碼", "验证码"
-   - Prefer 6-digit numeric if equally plausible
-
-2. **Alphanumeric codes**: Mix of letters and numbers (e.g., ABC123, XYZ789)
-   - Usually 6-10 characters
-   - Often capitalized
-
-3. **Tokens**: Long authentication strings (e.g., eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9)
-   - Usually 20+ characters
-   - May contain hyphens or underscores
-   - Often in URLs or after "token:" keyword
-   - Only choose if context explicitly indicates it's the verification code
+    async def _read_completion(self, response: httpx.Response) -> str:
+        """
+        讀取 chat/completions 的回覆內容
 
-CONFIDENCE SCORING (for the single choice):
-- 0.95-1.0: Code with explicit keywords (e.g., "Your code is 123456", "驗證碼：123456")
-- 0.85-0.94: Code in URL parameters (e.g., ?code=ABC123, &token=xyz)
-- 0.80-0.84: Standalone numbers/codes in appropriate context (e.g., email body with verification theme)
-- 0.70-0.79: Ambiguous matches that could be codes
+        SSE 流式回覆逐塊累積 delta.content，一旦緩衝區內已有可解析的 JSON 陣列即停止讀取；
+        緩衝區上限 _MAX_STREAM_CHARS。不支持流式的兼容端點仍按普通 JSON 回覆處理。
+        """
+        if "text/event-stream" not in response.headers.get("content-type", ""):
+            result = _json_loads(await response.aread())
+            return result["choices"][0]["message"]["content"]
+
+        parts: List[str] = []
+        size = 0
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                choices = _json_loads(payload).get("choices") or []
+            except ValueError:
+                continue
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if not delta:
+                continue
+
+            parts.append(delta)
+            size += len(delta)
+            if size >= _MAX_STREAM_CHARS:
+                break
+            if "]" in delta:
+                candidate = _slice_json_array("".join(parts))
+                if candidate is not None:
+                    try:
+                        _json_loads(candidate)
+                        break
+                    except ValueError:
+                        pass
+
+        return "".join(parts)[:_MAX_STREAM_CHARS]
 
-AVOID EXTRACTING:
-- Years (e.g., 2024, 2025)
-- Phone numbers
-- Prices or quantities
-- Regular English words (e.g., "below", "Hello", "within")
-- Dates or times
+    def _build_prompt(self, text: str) -> str:
+        """
+        構建 LLM 提示詞（限定只返回最有把握的一個）
 
-OUTPUT CONSTRAINTS:
-- Return a JSON array with at most 1 item (0 or 1).
-- No markdown or explanations.
+        固定的規則部分在前、郵件正文在後，使每次請求的前綴逐字節相同，便於服務端前綴緩存
+        """
+        return _PROMPT_PREFIX + _prompt_snippet(text, _PROMPT_TEXT_LIMIT) + _PROMPT_SUFFIX
 
-SINGLE-ITEM JSON EXAMPLE:
-[
-  {{
-    "code": "123456",
-    "type": "numeric",
-    "length": 6,
-    "confidence": 0.95,
-    "context": "verification code is"
-  }}
-]
-
-If no verification codes found or uncertain, return: []
+    def _parse_llm_response(self, content: str) -> Optional[List[Code]]:
+        """
+        解析 LLM 返回的 JSON 響應；若有多個，選擇信心最高的單一結果
 
-JSON Response:"""
+        兼容 {"result": [...]}（JSON mode）與裸陣列兩種格式：兩者都截取其中的 [...] 部分。
+        回覆為空、不含陣列或 JSON 無法解析時返回 None，以便與「確實沒有驗證碼」區分
+        """
 
-    def _parse_llm_response(self, content: str) -> List[Code]:
-        """解析 LLM 返回的 JSON 響應；若有多個，選擇信心最高的單一結果"""
+        if not content:
+            return None
 
         # 嘗試提取 JSON 陣列
-        json_match = re.search(r'\[[\s\S]*\]', content)
-        if not json_match:
-            return []
+        candidate = _slice_json_array(content)
+        if candidate is None:
+            return None
 
         try:
-            data = json.loads(json_match.group())
-
-            # 正常化：確保是列表
-            if isinstance(data, dict):
-                data = [data]
-            if not isinstance(data, list):
-                return []
-
-            candidates: List[Code] = []
-            seen = set()
-            for item in data:
-                # 驗證必需字段
-                if not isinstance(item, dict) or 'code' not in item:
-                    continue
-
-                raw_code = str(item['code']).strip()
-                if not raw_code:
-                    continue
-                # 去重（同一碼只保留一次）
-                if raw_code in seen:
-                    continue
-                seen.add(raw_code)
-
-                code_type = item.get('type', 'alphanumeric')
-                if code_type not in ['numeric', 'alphanumeric', 'token']:
-                    code_type = 'alphanumeric'
-
-                confidence = float(item.get('confidence', 0.8))
-                length = int(item.get('length', len(raw_code)))
-
-                candidates.append(Code(
-                    code=raw_code,
-                    type=code_type,
-                    length=length,
-                    pattern='llm_extracted',
-                    confidence=confidence
-                ))
-
-            if not candidates:
-                return []
-
-            # 排序規則：信心值優先，其次偏好數字碼（長度 4-8，特別是 6 位）
-            def rank_key(c: Code):
-                is_numeric = (c.type == 'numeric') and c.code.isdigit()
-                is_len6 = (c.length == 6)
-                is_len_4_8 = 4 <= c.length <= 8
-                return (
-                    -c.confidence,           # 高信心優先
-                    -(1 if is_numeric else 0),
-                    -(1 if is_len6 else 0),
-                    -(1 if is_len_4_8 else 0)
-                )
+            data = _json_loads(candidate)
 
-            candidates.sort(key=rank_key)
-
-            # 只返回最優單一結果
-            return [candidates[0]]
+            return self._select_best(data)
 
         except json.JSONDecodeError as e:
-            import asyncio
-            asyncio.create_task(log_service.log(
+            log_service.log_nowait(
                 level=LogLevel.ERROR,
                 log_type=LogType.CODE_EXTRACT,
                 message=f"Failed to parse LLM JSON response: {str(e)}",
@@ -449,21 +1050,70 @@ JSON Response:"""
                     "error_message": str(e),
                     "content_preview": content[:500]
                 }
-            ))
+            )
+            return None
+
+    def _select_best(self, data) -> List[Code]:
+        """從解析後的 JSON 數據中選出信心最高的單一驗證碼"""
+        # 正常化：確保是列表
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
             return []
 
+        # (排序鍵, Code)：排序鍵在構建時一次算好
+        # 規則：信心值優先，其次偏好數字碼（長度 4-8，特別是 6 位）
+        ranked: List[Tuple[tuple, Code]] = []
+        seen = set()
+        for item in data:
+            # 驗證必需字段
+            if not isinstance(item, dict) or 'code' not in item:
+                continue
+
+            raw_code = str(item['code']).strip()
+            if not raw_code:
+                continue
+            # 去重（同一碼只保留一次）
+            if raw_code in seen:
+                continue
+            seen.add(raw_code)
+
+            code_type = item.get('type', 'alphanumeric')
+            if code_type not in _CODE_TYPES:
+                code_type = 'alphanumeric'
+
+            confidence = float(item.get('confidence', 0.8))
+            length = int(item.get('length', len(raw_code)))
+
+            # 字段已在上方完成類型轉換；信心值合法時跳過 pydantic 逐字段校驗，
+            # 否則仍走常規構造，由 pydantic 校驗並拋出錯誤
+            build = Code.model_construct if 0.0 <= confidence <= 1.0 else Code
+            code = build(
+                code=raw_code,
+                type=code_type,
+                length=length,
+                pattern='llm_extracted',
+                confidence=confidence
+            )
+            rank = (
+                -confidence,  # 高信心優先
+                -(code_type == 'numeric' and raw_code.isdigit()),
+                -(length == 6),
+                -(4 <= length <= 8),
+            )
+            ranked.append((rank, code))
+
+        if not ranked:
+            return []
+
+        # 只需最優單一結果：線性 min 取代排序（相同排序鍵時保留先出現者，與穩定排序一致）
+        return [min(ranked, key=_BY_RANK)[1]]
+
     async def extract_from_html(self, html: str) -> List[Code]:
-        """從 HTML 中提取驗證碼"""
-        # 移除 HTML 標籤
-        text = re.sub(r"<[^>]*>", " ", html)
-        # 解碼 HTML 實體
-        text = self._decode_html_entities(text)
-        return await self.extract_codes(text)
-
-    def _decode_html_entities(self, text: str) -> str:
-        """解碼 HTML 實體"""
-        import html
-        return html.unescape(text)
+        """從 HTML 中提取驗證碼（selectolax 去標籤並解碼實體，未安裝時回退到正則）"""
+        if not html:
+            return []
+        return await self.extract_codes(html_to_text(html))
 
 
 # 單例
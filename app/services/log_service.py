@@ -82,6 +82,10 @@ class LogService:
         # 抽样计数器（降低 INFO/SUCCESS 级别的 I/O）
         self._info_counter = 0
         self._success_counter = 0
+        # 非阻塞日志队列与后台发布任务（首次调用 log_nowait 时创建）
+        self._queue: Optional[asyncio.Queue] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._queue_loop: Optional[asyncio.AbstractEventLoop] = None
         
         # 文件日誌配置
         self.file_logger: Optional[logging.Logger] = None
@@ -257,6 +261,58 @@ class LogService:
         if self._should_sample(entry):
             return
 
+        await self._publish(entry)
+
+    def log_nowait(
+        self,
+        level: LogLevel,
+        log_type: LogType,
+        message: str,
+        details: Optional[Dict] = None,
+        duration_ms: Optional[float] = None
+    ):
+        """
+        记录日志但不等待（放入队列，由后台任务写入并广播）
+
+        用于请求热路径上的非关键日志，避免日志广播的等待阻塞请求
+        """
+        entry = LogEntry(level, log_type, message, details, duration_ms)
+        if self._should_sample(entry):
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有运行中的事件循环：直接写入历史与文件
+            self.history.append(entry)
+            self._write_to_file(entry)
+            return
+
+        # 队列与事件循环绑定，事件循环变化（如重启）时重新创建
+        if self._queue is None or self._queue_loop is not loop:
+            self._queue = asyncio.Queue(maxsize=self.max_history)
+            self._queue_loop = loop
+            self._drain_task = None
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.create_task(self._drain_queue(self._queue))
+
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            # 积压过多时丢弃，日志不应拖慢主流程
+            pass
+
+    async def _drain_queue(self, queue: asyncio.Queue):
+        """后台任务：逐条发布队列中的日志"""
+        while True:
+            entry = await queue.get()
+            try:
+                await self._publish(entry)
+            except Exception as e:
+                print(f"⚠️ Log publish error: {e}")
+
+    async def _publish(self, entry: LogEntry):
+        """写入历史记录与文件，并广播给订阅者"""
         async with self._lock:
             # 添加到内存历史记录
             self.history.append(entry)
@@ -527,8 +527,11 @@ class MailService:
             # 使用 LLM 提取
             from app.services.llm_code_service import llm_code_service
 
-            for mail in mails:
-                codes = await llm_code_service.extract_codes(mail.content)
+            # 纯文本合并为一次批量请求；结果为空的邮件再尝试 HTML
+            batch_codes = await llm_code_service.extract_codes_batch(
+                [mail.content for mail in mails]
+            )
+            for mail, codes in zip(mails, batch_codes):
                 if not codes and mail.html_content:
                     # 如果纯文本没有验证码，尝试从HTML提取
                     codes = await llm_code_service.extract_from_html(mail.html_content)
@@ -4,8 +4,11 @@
 """
 
 import json
+import os
 import re
 import secrets
+import tempfile
+import threading
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
@@ -18,6 +21,8 @@ class PatternService:
     def __init__(self):
         self.patterns_file = Path("data/patterns.json")
         self.patterns: List[Pattern] = []
+        # 提取在線程池中執行，increment_usage 可能被並發調用；保護計數更新與文件寫入
+        self._lock = threading.RLock()
         self._ensure_data_directory()
         self._load_patterns()
     
@@ -39,14 +44,28 @@ class PatternService:
     def _save_patterns(self):
         """保存模式到文件"""
         try:
-            data = [p.model_dump(mode='json') for p in self.patterns]
-            self.patterns_file.write_text(
-                json.dumps(data, ensure_ascii=False, indent=2),
-                encoding="utf-8"
-            )
+            with self._lock:
+                data = [p.model_dump(mode='json') for p in self.patterns]
+                self._atomic_write(json.dumps(data, ensure_ascii=False, indent=2))
         except Exception as e:
             print(f"[Pattern Service] Failed to save patterns: {e}")
     
+    def _atomic_write(self, content: str):
+        """以臨時檔案 + os.replace 原子地替換模式文件，避免並發寫入或中斷留下殘缺的 JSON"""
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f".{self.patterns_file.name}.", suffix=".tmp", dir=self.patterns_file.parent
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, self.patterns_file)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
     def learn_from_highlight(
         self, 
         email_content: str, 
@@ -171,12 +190,13 @@ class PatternService:
     
     def increment_usage(self, pattern_id: str, success: bool = True):
         """增加模式使用次數"""
-        pattern = self.get_pattern_by_id(pattern_id)
-        if pattern:
-            pattern.usage_count += 1
-            if success:
-                pattern.success_count += 1
-            self._save_patterns()
+        with self._lock:
+            pattern = self.get_pattern_by_id(pattern_id)
+            if pattern:
+                pattern.usage_count += 1
+                if success:
+                    pattern.success_count += 1
+                self._save_patterns()
     
     def get_stats(self) -> dict:
         """獲取統計信息"""
@@ -6,10 +6,28 @@
 """
 
 import re
+import uuid
 from typing import Optional
 from html import escape
 
 
+# 預編譯的正則（模塊加載時編譯一次）
+# <url> 格式（如 <https://aka.ms/GetOutlookForMac>）
+_ANGLE_BRACKET_URL_RE = re.compile(r'<(https?://[^>]+)>')
+
+# [url] 格式（如 [https://example.com/image.jpg]）
+_BRACKET_URL_RE = re.compile(r'\[(https?://[^\]]+)\]')
+
+# 已轉換為 HTML 的受保護區域
+_PROTECTED_RE = re.compile(r'\{\{PROTECTED\}\}(.*?)\{\{/PROTECTED\}\}', re.DOTALL)
+
+# 普通 URL（已被 escape 的文本）；負向後行斷言跳過已經在 HTML 屬性中的 URL
+_PLAIN_URL_RE = re.compile(r'(?<!href=")(?<!src=")https?://[^\s<>&\'"]+[^\s<>&\'".,;:!?)]')
+
+# Markdown 圖片/連結：![alt](url) 或 [alt](url)
+_MARKDOWN_LINK_RE = re.compile(r'!?\[([^\]]*)\]\(([^)]+)\)')
+
+
 class TextToHtmlService:
     """纯文本转 HTML 转换器"""
 
@@ -18,6 +36,12 @@ class TextToHtmlService:
         '.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg', '.ico'
     }
 
+    # 常見圖片 CDN 或路徑關鍵字
+    IMAGE_KEYWORDS = (
+        '/images/', '/img/', '/image/', '/picture/', '/photo/',
+        'imgur.com', 'cloudinary.com', 'imgix.net'
+    )
+
     def convert_text_to_html(self, text: str) -> str:
         """
         将纯文本转换为 HTML，自动识别：
@@ -74,7 +98,9 @@ class TextToHtmlService:
         Returns:
             替换后的文本 (使用 Unicode 占位符，避免被 escape 干扰)
         """
-        import uuid
+        # 兩種格式都要求 http(s):// 開頭，不含 "http" 的文本直接跳過
+        if 'http' not in text:
+            return text
 
         # 儲存 URL 映射 (使用實例變量臨時存儲)
         if not hasattr(self, '_temp_url_map'):
@@ -94,7 +120,7 @@ class TextToHtmlService:
             return placeholder
 
         # 匹配 <url> 格式
-        text = re.sub(r'<(https?://[^>]+)>', replace_angle_bracket_url, text)
+        text = _ANGLE_BRACKET_URL_RE.sub(replace_angle_bracket_url, text)
 
         # 處理 [url] 格式 (如 [https://example.com/image.jpg])
         def replace_bracket_url(match):
@@ -113,7 +139,7 @@ class TextToHtmlService:
                 return f'[{url}]'
 
         # 匹配 [url] 格式
-        text = re.sub(r'\[(https?://[^\]]+)\]', replace_bracket_url, text)
+        text = _BRACKET_URL_RE.sub(replace_bracket_url, text)
 
         return text
 
@@ -162,20 +188,21 @@ class TextToHtmlService:
         - 常见图片格式自动转换为 <img>
         - Markdown 格式的图片 [描述](url)
         """
+        # 不含 "http" 時既沒有 URL 也沒有受保護區域，只需處理 Markdown 圖片
+        if 'http' not in text:
+            return self._convert_markdown_images(text)
+
         # 步驟 1: 分離受保護區域
         protected_sections = []
-        protected_pattern = r'\{\{PROTECTED\}\}(.*?)\{\{/PROTECTED\}\}'
 
         def save_protected(match):
             index = len(protected_sections)
             protected_sections.append(match.group(1))
             return f'__PROTECTED_{index}__'
 
-        text = re.sub(protected_pattern, save_protected, text, flags=re.DOTALL)
+        text = _PROTECTED_RE.sub(save_protected, text)
 
-        # 步驟 2: 匹配普通 URL（已被 escape 的字符）
-        # 使用負向先行斷言，跳過已經在 HTML 屬性中的 URL
-        url_pattern = r'(?<!href=")(?<!src=")https?://[^\s<>&\'"]+[^\s<>&\'".,;:!?)]'
+        # 步驟 2: 匹配普通 URL（已被 escape 的字符），跳過已經在 HTML 屬性中的 URL
 
         def replace_url(match):
             url = match.group(0)
@@ -189,7 +216,7 @@ class TextToHtmlService:
                 return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{url}</a>'
 
         # 替換所有 URL
-        result = re.sub(url_pattern, replace_url, text)
+        result = _PLAIN_URL_RE.sub(replace_url, text)
 
         # 步驟 3: 還原受保護區域
         for index, content in enumerate(protected_sections):
@@ -208,24 +235,7 @@ class TextToHtmlService:
         1. 文件扩展名
         2. 常见图片 CDN 域名
         """
-        url_lower = url.lower()
-
-        # 檢查文件擴展名
-        for ext in self.IMAGE_EXTENSIONS:
-            if ext in url_lower:
-                return True
-
-        # 檢查常見圖片 CDN 或路徑關鍵字
-        image_keywords = [
-            '/images/', '/img/', '/image/', '/picture/', '/photo/',
-            'imgur.com', 'cloudinary.com', 'imgix.net'
-        ]
-
-        for keyword in image_keywords:
-            if keyword in url_lower:
-                return True
-
-        return False
+        return _IMAGE_URL_HINT_RE.search(url) is not None
 
     def _convert_markdown_images(self, text: str) -> str:
         """
@@ -233,8 +243,6 @@ class TextToHtmlService:
 
         例如: [image](https://example.com/image.jpg)
         """
-        # 匹配 ![alt](url) 或 [alt](url) 格式
-        pattern = r'!?\[([^\]]*)\]\(([^)]+)\)'
 
         def replace_markdown(match):
             alt_text = match.group(1) or '邮件图片'
@@ -246,7 +254,7 @@ class TextToHtmlService:
                 # 如果不是圖片，轉換為普通連結
                 return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{escape(alt_text) if alt_text else url}</a>'
 
-        return re.sub(pattern, replace_markdown, text)
+        return _MARKDOWN_LINK_RE.sub(replace_markdown, text)
 
     def enhance_html_content(self, text_content: str, html_content: Optional[str]) -> str:
         """
@@ -267,5 +275,17 @@ class TextToHtmlService:
             return self.convert_text_to_html(text_content)
 
 
+# 圖片 URL 判斷：擴展名與關鍵字合併為一個不區分大小寫的正則，單次掃描完成
+_IMAGE_URL_HINT_RE = re.compile(
+    "|".join(
+        re.escape(hint)
+        for hint in sorted(
+            TextToHtmlService.IMAGE_EXTENSIONS | set(TextToHtmlService.IMAGE_KEYWORDS)
+        )
+    ),
+    re.IGNORECASE,
+)
+
+
 # 單例
 text_to_html_service = TextToHtmlService()